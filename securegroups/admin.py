@@ -5,8 +5,9 @@ from .app_settings import USING_DISCORD_SERVICE
 # Register your models here.
 from .models import (
     AltAllianceFilter, AltCorpFilter, FilterExpression, GracePeriodRecord,
-    GroupUpdateWebhook, SmartFilter, SmartGroup, UserInGroupFilter, DiscordActivatedFilter
+    GroupUpdateWebhook, SmartFilter, SmartGroup, SmartGroupRun, UserInGroupFilter, DiscordActivatedFilter
 )
+from .tasks import bump_groups_view
 
 
 @admin.register(GracePeriodRecord)
@@ -30,13 +31,59 @@ class GraceAdmin(admin.ModelAdmin):
     def group_name(self, obj):
         return obj.group.group.name
 
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_groups_view({obj.user_id})
+
+    def delete_queryset(self, request, queryset):
+        user_ids = set(queryset.values_list("user_id", flat=True))
+        super().delete_queryset(request, queryset)
+        bump_groups_view(user_ids)
+
 
 @admin.register(SmartFilter)
 class SmartfilterAdmin(admin.ModelAdmin):
     def has_add_permission(self, request, obj=None):
         return False
 
-    list_display = ["__str__", "grace_period"]
+    list_select_related = ["stats"]
+    list_display = ["__str__", "grace_period", "calls", "avg_time",
+                    "time_per_user", "avg_queries", "avg_users", "fail_rate", "fallback_rate"]
+
+    @admin.display(description="Calls", ordering="stats__calls")
+    def calls(self, obj):
+        stats = getattr(obj, "stats", None)
+        return stats.calls if stats else None
+
+    @admin.display(description="Avg Time (ms)", ordering="stats__avg_time")
+    def avg_time(self, obj):
+        stats = getattr(obj, "stats", None)
+        return f"{stats.avg_time * 1000:.1f}" if stats else None
+
+    @admin.display(description="Per User (ms)")
+    def time_per_user(self, obj):
+        stats = getattr(obj, "stats", None)
+        return f"{stats.time_per_user * 1000:.3f}" if stats else None
+
+    @admin.display(description="Avg Queries", ordering="stats__avg_queries")
+    def avg_queries(self, obj):
+        stats = getattr(obj, "stats", None)
+        return f"{stats.avg_queries:.1f}" if stats else None
+
+    @admin.display(description="Avg Users", ordering="stats__avg_users")
+    def avg_users(self, obj):
+        stats = getattr(obj, "stats", None)
+        return f"{stats.avg_users:.0f}" if stats else None
+
+    @admin.display(description="Fail Rate", ordering="stats__fail_rate")
+    def fail_rate(self, obj):
+        stats = getattr(obj, "stats", None)
+        return f"{stats.fail_rate:.0%}" if stats else None
+
+    @admin.display(description="Fallbacks", ordering="stats__fallback_rate")
+    def fallback_rate(self, obj):
+        stats = getattr(obj, "stats", None)
+        return f"{stats.fallback_rate:.0%}" if stats else None
 
 
 @admin.register(SmartGroup)
@@ -46,6 +93,22 @@ class SmartGroupAdmin(admin.ModelAdmin):
                     "include_in_updates", "can_grace"]
 
 
+@admin.register(SmartGroupRun)
+class SmartGroupRunAdmin(admin.ModelAdmin):
+    list_select_related = ["group__group"]
+    list_display = ["group", "started", "duration", "mode", "shards", "checked",
+                    "added", "removed", "pending_removals", "queries",
+                    "population_time", "bulk_time", "loop_time", "write_time", "notify_time"]
+    list_filter = ["group", "mode", "fake_run"]
+    date_hierarchy = "started"
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(AltCorpFilter)
 class AltCorpAdmin(admin.ModelAdmin):
     list_select_related = ["alt_corp"]
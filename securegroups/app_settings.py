@@ -8,4 +8,25 @@ def discord_bot_active():
 DISCORD_BOT_COGS = getattr(settings, 'SG_DISCORD_BOT_COGS', ["securegroups.cogs.groupcheck",
                                                              ])
 USING_DISCORD_SERVICE = clean_setting("USING_DISCORD_SERVICE", False)
-""" Whether or not using AA's Discord Service for Discord Service Filter"""
\ No newline at end of file
+""" Whether or not using AA's Discord Service for Discord Service Filter"""
+
+SG_EXPRESSION_MAX_DEPTH = clean_setting("SG_EXPRESSION_MAX_DEPTH", 10)
+""" How deep Filter Expressions can be nested before they are refused"""
+
+SG_PARALLEL_UPDATES = clean_setting("SG_PARALLEL_UPDATES", False)
+""" Run the scheduled Smart Group updates in parallel lanes instead of one after another"""
+
+SG_PARALLEL_UPDATE_LANES = clean_setting("SG_PARALLEL_UPDATE_LANES", 4)
+""" How many Smart Group updates can run at once in parallel mode"""
+
+SG_UPDATE_SHARD_SIZE = clean_setting("SG_UPDATE_SHARD_SIZE", 0)
+""" Split Smart Groups with more users than this to check into parallel shards, 0 to never split"""
+
+SG_DISCORD_DM_PER_MINUTE = clean_setting("SG_DISCORD_DM_PER_MINUTE", 60, min_value=1)
+""" Discord DMs sent per minute on average"""
+
+SG_DISCORD_DM_BURST = clean_setting("SG_DISCORD_DM_BURST", 5, min_value=1)
+""" Discord DMs that can be sent back to back before the rate limit kicks in"""
+
+SG_RUN_HISTORY_DAYS = clean_setting("SG_RUN_HISTORY_DAYS", 30)
+""" Days to keep the Smart Group update history for"""
@@ -1,10 +1,15 @@
 import logging
-from typing import List
+from contextvars import ContextVar
+from typing import List, Set
 
 from django.contrib.auth.models import Group, User
+from django.db.models import Q
 
 logger = logging.getLogger(__name__)
 
+# called with the filter when a bulk check falls back to single user checks
+fallback_listener = ContextVar("sg_fallback_listener", default=None)
+
 
 def check_alt_alli_on_account(user: User, alt_alli_id, exempt_corps=False, exempt_allis=False):
     try:
@@ -16,14 +21,10 @@ def check_alt_alli_on_account(user: User, alt_alli_id, exempt_corps=False, exemp
             if user.profile.main_character.corporation_id in exempt_corps:
                 return True
 
-        character_list = user.character_ownerships.all().select_related("character")
-        character_count = character_list.filter(
-            character__alliance_id=alt_alli_id
-        ).count()
-        if character_count > 0:
-            return True
-        else:
-            return False
+        from .models import UserAffiliation
+        return UserAffiliation.objects.filter(
+            user=user, alliance_id=alt_alli_id
+        ).exists()
     except Exception:
         return False
 
@@ -31,8 +32,6 @@ def check_alt_alli_on_account(user: User, alt_alli_id, exempt_corps=False, exemp
 def check_alt_corp_on_account(user: User, alt_corp_id, exempt_corps=False, exempt_allis=False):
     # logger.debug("Checking {0} for alt in corp {1}".format(character_id, alt_corp_id))
     try:
-        character_list = user.character_ownerships.all().select_related("character")
-
         if exempt_allis:
             if user.profile.main_character.alliance_id in exempt_allis:
                 return True
@@ -41,13 +40,10 @@ def check_alt_corp_on_account(user: User, alt_corp_id, exempt_corps=False, exemp
             if user.profile.main_character.corporation_id in exempt_corps:
                 return True
 
-        character_count = character_list.filter(
-            character__corporation_id=alt_corp_id
-        ).count()
-        if character_count > 0:
-            return True
-        else:
-            return False
+        from .models import UserAffiliation
+        return UserAffiliation.objects.filter(
+            user=user, corporation_id=alt_corp_id
+        ).exists()
     except Exception:
         return False
 
@@ -67,3 +63,64 @@ def check_group_on_account(user: User, groups: List[Group], exempt_corps=False,
         return False
     except Exception:
         return False
+
+
+class FilterCompileError(Exception):
+    """The filter can't be safely turned into a query"""
+
+
+class FilterCycleError(FilterCompileError):
+    """An expression references itself somewhere down its terms"""
+
+
+class FilterDepthError(FilterCompileError):
+    """An expression is nested deeper than `SG_EXPRESSION_MAX_DEPTH`"""
+
+
+def exempt_q(exempt_corps=False, exempt_allis=False) -> Q:
+    """
+    Bulk version of the exemption checks above, matches any `User`
+    whose main character is in an exempt alliance or corporation.
+    """
+    _q = Q()
+    if exempt_allis:
+        _q |= Q(profile__main_character__alliance_id__in=exempt_allis)
+    if exempt_corps:
+        _q |= Q(profile__main_character__corporation_id__in=exempt_corps)
+    return _q
+
+
+def audit_passing_user_ids(filter_object, users) -> Set[int]:
+    """
+    Build the passing set from `audit_filter`, falling back to `process_filter`
+    one user at a time if the bulk check fails.
+    """
+    try:
+        results = filter_object.audit_filter(users)
+        passing = set()
+        for uid in users.values_list("pk", flat=True):
+            try:
+                if results[uid]["check"]:
+                    passing.add(uid)
+            except KeyError:
+                pass
+        return passing
+    except Exception:
+        logger.warning(
+            f"Bulk check failed for {filter_object}, falling back to single user checks"
+        )
+        listener = fallback_listener.get()
+        if listener:
+            listener(filter_object)
+        return {u.pk for u in users if filter_object.process_filter(u)}
+
+
+def passing_user_ids(filter_object, users) -> Set[int]:
+    """
+    Set of `User.id`s from the `users` queryset that pass `filter_object`.
+    Third party filters that don't provide `passing_user_ids` are run through
+    their `audit_filter` instead.
+    """
+    if hasattr(filter_object, "passing_user_ids"):
+        return filter_object.passing_user_ids(users)
+    return audit_passing_user_ids(filter_object, users)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from securegroups.models import UserAffiliation
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the user corporation/alliance index used by the Secure Groups filters'
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding the Secure Groups affiliation index")
+        UserAffiliation.rebuild()
+        self.stdout.write(
+            f"Success! {UserAffiliation.objects.all().count()} affiliations indexed"
+        )
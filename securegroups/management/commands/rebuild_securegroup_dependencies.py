@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from securegroups.models import FilterDependency, SmartFilter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the index of which corporations, alliances and groups each Smart Filter depends on'
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding the Secure Groups filter dependency index")
+        FilterDependency.rebuild()
+        self.stdout.write(
+            f"Success! {SmartFilter.objects.filter(dependencies_indexed=True).count()} filters indexed, "
+            f"{SmartFilter.objects.filter(dependencies_indexed=False).count()} can't be indexed and are always re-checked"
+        )
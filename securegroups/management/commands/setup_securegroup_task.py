@@ -23,4 +23,36 @@ class Command(BaseCommand):
                 'enabled': True
             }
         )
+        self.stdout.write("Creating/Updating the Secure Groups Changed User Task")
+        schedule, _ = CrontabSchedule.objects.get_or_create(minute='*/5',
+                                                            hour='*',
+                                                            day_of_week='*',
+                                                            day_of_month='*',
+                                                            month_of_year='*',
+                                                            timezone='UTC'
+                                                            )
+        PeriodicTask.objects.update_or_create(
+            task='securegroups.tasks.run_pending_user_checks',
+            defaults={
+                'crontab': schedule,
+                'name': 'Secure Group Changed User Checks',
+                'enabled': True
+            }
+        )
+        self.stdout.write("Creating/Updating the Secure Groups Expired Grace Task")
+        schedule, _ = CrontabSchedule.objects.get_or_create(minute='*/15',
+                                                            hour='*',
+                                                            day_of_week='*',
+                                                            day_of_month='*',
+                                                            month_of_year='*',
+                                                            timezone='UTC'
+                                                            )
+        PeriodicTask.objects.update_or_create(
+            task='securegroups.tasks.process_expired_graces',
+            defaults={
+                'crontab': schedule,
+                'name': 'Secure Group Expired Graces',
+                'enabled': True
+            }
+        )
         self.stdout.write("Success!")
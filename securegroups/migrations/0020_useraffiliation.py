@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_affiliations(apps, schema_editor):
+    CharacterOwnership = apps.get_model('authentication', 'CharacterOwnership')
+    UserAffiliation = apps.get_model('securegroups', 'UserAffiliation')
+
+    rows = CharacterOwnership.objects.values_list(
+        'user_id', 'character__corporation_id', 'character__alliance_id'
+    ).order_by().distinct()
+    UserAffiliation.objects.bulk_create(
+        [
+            UserAffiliation(user_id=u, corporation_id=c, alliance_id=a)
+            for u, c, a in set(rows)
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('securegroups', '0019_discordactivatedfilter_negate_result'),
+        ('authentication', '0016_ownershiprecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAffiliation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('corporation_id', models.PositiveIntegerField()),
+                ('alliance_id', models.PositiveIntegerField(blank=True, default=None, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'default_permissions': (),
+                'indexes': [models.Index(fields=['corporation_id', 'user'], name='securegroup_corpora_23ccd9_idx'), models.Index(fields=['alliance_id', 'user'], name='securegroup_allianc_698f26_idx')],
+            },
+        ),
+        migrations.RunPython(build_affiliations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:10
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_graces(apps, schema_editor):
+    # keep the oldest record for each group/user/filter
+    GracePeriodRecord = apps.get_model('securegroups', 'GracePeriodRecord')
+
+    dupes = GracePeriodRecord.objects.values(
+        'group', 'user', 'grace_filter'
+    ).annotate(
+        keep=Min('pk'), total=Count('pk')
+    ).filter(total__gt=1)
+    for d in dupes:
+        GracePeriodRecord.objects.filter(
+            group=d['group'], user=d['user'], grace_filter=d['grace_filter']
+        ).exclude(pk=d['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0020_useraffiliation'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_graces, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='graceperiodrecord',
+            constraint=models.UniqueConstraint(fields=('group', 'user', 'grace_filter'), name='securegroups_unique_grace_record'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0022_pendingusercheck'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smartfilter',
+            name='dependencies_indexed',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.CreateModel(
+            name='FilterDependency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('corporation', 'Corporation'), ('alliance', 'Alliance'), ('group', 'Group')], max_length=12)),
+                ('target_id', models.BigIntegerField()),
+                ('smart_filter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependencies', to='securegroups.smartfilter')),
+            ],
+            options={
+                'default_permissions': (),
+                'indexes': [models.Index(fields=['kind', 'target_id'], name='securegroup_kind_443813_idx')],
+            },
+        ),
+    ]
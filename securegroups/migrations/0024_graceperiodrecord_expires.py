@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0023_filterdependency'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='graceperiodrecord',
+            index=models.Index(fields=['expires'], name='securegroup_expires_e19705_idx'),
+        ),
+    ]
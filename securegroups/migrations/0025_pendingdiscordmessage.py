@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('securegroups', '0024_graceperiodrecord_expires'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingDiscordMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, default='', max_length=256)),
+                ('message', models.TextField()),
+                ('color', models.PositiveIntegerField(blank=True, default=None, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'default_permissions': (),
+                'indexes': [models.Index(fields=['next_attempt'], name='securegroup_next_at_8f5dd8_idx')],
+            },
+        ),
+    ]
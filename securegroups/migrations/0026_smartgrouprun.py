@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0025_pendingdiscordmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SmartGroupRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField()),
+                ('duration', models.FloatField(default=0)),
+                ('mode', models.CharField(choices=[('full', 'Every filter on every user'), ('short_circuit', 'Stop at first failure')], default='full', max_length=16)),
+                ('shards', models.PositiveIntegerField(default=1)),
+                ('fake_run', models.BooleanField(default=False)),
+                ('checked', models.PositiveIntegerField(default=0)),
+                ('added', models.PositiveIntegerField(default=0)),
+                ('removed', models.PositiveIntegerField(default=0)),
+                ('pending_removals', models.PositiveIntegerField(default=0)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('population_time', models.FloatField(default=0)),
+                ('bulk_time', models.FloatField(default=0)),
+                ('loop_time', models.FloatField(default=0)),
+                ('write_time', models.FloatField(default=0)),
+                ('notify_time', models.FloatField(default=0)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='securegroups.smartgroup')),
+            ],
+            options={
+                'default_permissions': ('view',),
+                'indexes': [models.Index(fields=['group', '-started'], name='securegroup_group_i_625068_idx')],
+            },
+        ),
+    ]
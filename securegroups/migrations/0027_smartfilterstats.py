@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0026_smartgrouprun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SmartFilterStats',
+            fields=[
+                ('smart_filter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='securegroups.smartfilter')),
+                ('calls', models.PositiveBigIntegerField(default=0)),
+                ('avg_time', models.FloatField(default=0)),
+                ('avg_queries', models.FloatField(default=0)),
+                ('avg_users', models.FloatField(default=0)),
+                ('fallback_rate', models.FloatField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0027_smartfilterstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditSnapshot',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='audit_snapshot', serialize=False, to='securegroups.smartgroup')),
+                ('created', models.DateTimeField()),
+                ('filters', models.JSONField(default=list)),
+                ('results', models.JSONField(default=dict)),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+    ]
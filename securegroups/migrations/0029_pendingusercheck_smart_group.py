@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('securegroups', '0028_auditsnapshot'),
+    ]
+
+    # the queue is rebuilt with the groups each change affects,
+    # anything waiting is picked up by the next full update
+    operations = [
+        migrations.DeleteModel(
+            name='PendingUserCheck',
+        ),
+        migrations.CreateModel(
+            name='PendingUserCheck',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('smart_group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='securegroups.smartgroup')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='pendingusercheck',
+            constraint=models.UniqueConstraint(fields=('user', 'smart_group'), name='securegroups_unique_pending_check'),
+        ),
+    ]
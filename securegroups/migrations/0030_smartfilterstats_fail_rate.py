@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0029_pendingusercheck_smart_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smartfilterstats',
+            name='fail_rate',
+            field=models.FloatField(default=0),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:40
+
+from django.db import migrations
+
+
+def build_dependencies(apps, schema_editor):
+    # the filters that ship with this app, anything else stays unindexed
+    # until `rebuild_securegroup_dependencies` or its next save
+    SmartFilter = apps.get_model('securegroups', 'SmartFilter')
+    FilterDependency = apps.get_model('securegroups', 'FilterDependency')
+
+    def exemptions(f):
+        return (
+            [('alliance', a) for a in f.exempt_alliances.values_list('alliance_id', flat=True)]
+            + [('corporation', c) for c in f.exempt_corporations.values_list('corporation_id', flat=True)]
+        )
+
+    builders = {
+        'altcorpfilter': lambda f: [('corporation', f.alt_corp.corporation_id)] + exemptions(f),
+        'altalliancefilter': lambda f: [('alliance', f.alt_alli.alliance_id)] + exemptions(f),
+        'useringroupfilter': lambda f: (
+            [('group', g) for g in f.groups.values_list('pk', flat=True)] + exemptions(f)
+        ),
+        'discordactivatedfilter': lambda f: [],
+    }
+
+    def dependencies(sf, path=()):
+        if sf.pk in path or sf.content_type.app_label != 'securegroups':
+            return None
+        model = sf.content_type.model
+        if model == 'filterexpression':
+            expression = apps.get_model('securegroups', model).objects.filter(pk=sf.object_id).first()
+            if expression is None:
+                return None
+            terms = [
+                dependencies(term, path + (sf.pk,))
+                for term in (expression.first_term, expression.second_term)
+            ]
+            if None in terms:
+                return None
+            return terms[0] + terms[1]
+        if model not in builders:
+            return None
+        _filter = apps.get_model('securegroups', model).objects.filter(pk=sf.object_id).first()
+        return None if _filter is None else builders[model](_filter)
+
+    rows = []
+    indexed = []
+    for sf in SmartFilter.objects.select_related('content_type'):
+        found = dependencies(sf)
+        if found is None:
+            continue
+        indexed.append(sf.pk)
+        rows += [
+            FilterDependency(smart_filter_id=sf.pk, kind=kind, target_id=target_id)
+            for kind, target_id in set(found)
+            if target_id is not None
+        ]
+    FilterDependency.objects.filter(smart_filter_id__in=indexed).delete()
+    FilterDependency.objects.bulk_create(rows, batch_size=1000)
+    SmartFilter.objects.filter(pk__in=indexed).update(dependencies_indexed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securegroups', '0030_smartfilterstats_fail_rate'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_dependencies, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,14 @@
+import uuid
 from collections import defaultdict
+from typing import NamedTuple
 
 from django.contrib.auth.models import Group, User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
 from django.apps import apps
 
@@ -11,9 +16,7 @@ from allianceauth.authentication.models import CharacterOwnership
 from allianceauth.eveonline.models import EveAllianceInfo, EveCorporationInfo
 
 from . import app_settings, filter as smart_filters
-
-if app_settings.discord_bot_active():
-    import aadiscordbot
+from .planner import STATS_SMOOTHING, FilterPlanner, FilterProfiler
 
 import logging
 
@@ -41,6 +44,8 @@ class SmartFilter(models.Model):
     object_id = models.PositiveIntegerField(editable=False)
     filter_object = GenericForeignKey("content_type", "object_id")
     grace_period = models.IntegerField(default=5)
+    # False until FilterDependency knows what this filter depends on
+    dependencies_indexed = models.BooleanField(default=False, editable=False)
 
     def __str__(self):
         try:
@@ -48,12 +53,116 @@ class SmartFilter(models.Model):
         except:  # noqa: E722
             return f"Error: {self.content_type.app_label}:{self.content_type} {self.object_id} Not Found"
 
+    @classmethod
+    def resolve_filter_objects(cls, smart_filters):
+        """
+        Load the `filter_object` of every `SmartFilter` in one query per content type,
+        with the related data each filter type asks for in `with_related`.
+        The terms of expressions are loaded the same way. Returns the `SmartFilter`s as a list.
+        """
+        smart_filters = list(smart_filters)
+        field = cls._meta.get_field("filter_object")
+        resolved = {}
+        pending = smart_filters
+        while pending:
+            by_type = defaultdict(list)
+            for sf in pending:
+                if sf.pk in resolved:
+                    # also stops expressions that loop back on themselves
+                    field.set_cached_value(sf, resolved[sf.pk])
+                elif not field.is_cached(sf):
+                    by_type[sf.content_type_id].append(sf)
+            pending = []
+            for ct_id, sfs in by_type.items():
+                model = ContentType.objects.get_for_id(ct_id).model_class()
+                if model is None:
+                    continue  # app has gone, filter_object will be None anyway
+                qs = model._default_manager.filter(pk__in={sf.object_id for sf in sfs})
+                if hasattr(model, "with_related"):
+                    qs = model.with_related(qs)
+                objects = qs.in_bulk()
+                for sf in sfs:
+                    _filter = objects.get(sf.object_id)
+                    field.set_cached_value(sf, _filter)
+                    if sf.pk not in resolved and isinstance(_filter, FilterExpression):
+                        pending += [_filter.first_term, _filter.second_term]
+                    resolved[sf.pk] = _filter
+        return smart_filters
+
+
+class SmartFilterStats(models.Model):
+    """
+    Rolling averages of what a `SmartFilter` costs per call and how often it fails,
+    fed by `planner.FilterProfiler`, shown in the admin and used by `planner.FilterPlanner`.
+    """
+    smart_filter = models.OneToOneField(
+        SmartFilter, on_delete=models.CASCADE, primary_key=True, related_name="stats"
+    )
+    calls = models.PositiveBigIntegerField(default=0)
+    avg_time = models.FloatField(default=0)
+    avg_queries = models.FloatField(default=0)
+    avg_users = models.FloatField(default=0)
+    # share of calls that had to check users one at a time
+    fallback_rate = models.FloatField(default=0)
+    # share of the users checked that failed
+    fail_rate = models.FloatField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        default_permissions = ()
+
+    def __str__(self):
+        return f"Stats: {self.smart_filter_id}"
+
+    @property
+    def time_per_user(self):
+        return self.avg_time / self.avg_users if self.avg_users else 0
+
+    @classmethod
+    def record(cls, samples):
+        """
+        Fold a batch of `FilterProfiler` samples keyed by `SmartFilter.id` into the averages.
+        """
+        fields = ["avg_time", "avg_queries", "avg_users", "fallback_rate", "fail_rate"]
+        existing = cls.objects.in_bulk(list(samples.keys()))
+        now = timezone.now()
+        new = []
+        changed = []
+        for filter_id, sample in samples.items():
+            calls = sample["calls"]
+            if not calls:
+                continue
+            latest = {
+                "avg_time": sample["seconds"] / calls,
+                "avg_queries": sample["queries"] / calls,
+                "avg_users": sample["users"] / calls,
+                "fallback_rate": sample["fallbacks"] / calls,
+            }
+            if sample.get("checked"):
+                latest["fail_rate"] = sample["failed"] / sample["checked"]
+            stats = existing.get(filter_id)
+            if stats is None:
+                new.append(cls(smart_filter_id=filter_id, calls=calls, **latest))
+                continue
+            stats.calls += calls
+            stats.updated = now
+            for field, value in latest.items():
+                current = getattr(stats, field)
+                setattr(stats, field, current + STATS_SMOOTHING * (value - current))
+            changed.append(stats)
+        cls.objects.bulk_create(new, ignore_conflicts=True)
+        cls.objects.bulk_update(changed, ["calls", "updated", *fields])
+
 
 class FilterBase(models.Model):
 
     name = models.CharField(max_length=500)
     description = models.CharField(max_length=500)
 
+    # Results can be shared between groups in the same update cycle.
+    # Turn this off for anything that depends on data the cycle itself changes, eg group membership.
+    cache_in_cycle = True
+
     class Meta:
         abstract = True
 
@@ -66,6 +175,39 @@ class FilterBase(models.Model):
     def audit_filter(self, users):
         raise NotImplementedError("Please Create an audit function!")
 
+    def user_q(self) -> Q:
+        """
+        This filter as a `Q` over `User`, so it can be run as a single query
+        or compiled into a larger expression.
+        """
+        raise NotImplementedError("Filter can't be run as a query")
+
+    def get_dependencies(self):
+        """
+        `(kind, id)` pairs for every corporation, alliance and group
+        this filter looks at, see `FilterDependency`.
+        """
+        raise NotImplementedError("Filter can't list its dependencies")
+
+    @classmethod
+    def with_related(cls, queryset):
+        """
+        Add the related data this filter uses to `queryset`,
+        used by `SmartFilter.resolve_filter_objects` to load filters in bulk.
+        """
+        return queryset
+
+    def passing_user_ids(self, users):
+        """
+        Set of `User.id`s from the `users` queryset that pass this filter.
+        Runs `user_q` where the filter has one, otherwise it is built from `audit_filter`.
+        """
+        try:
+            _q = self.user_q()
+        except NotImplementedError:
+            return smart_filters.audit_passing_user_ids(self, users)
+        return set(users.filter(_q).values_list("pk", flat=True))
+
 
 class DiscordActivatedFilter(FilterBase):
     class Meta:
@@ -122,6 +264,24 @@ class DiscordActivatedFilter(FilterBase):
 
         return output
 
+    def user_q(self):
+        if not apps.is_installed("allianceauth.services.modules.discord") or not app_settings.USING_DISCORD_SERVICE:
+            return Q(pk__isnull=True)  # nobody passes
+
+        from allianceauth.services.modules.discord.models import DiscordUser
+
+        return Q(
+            Exists(
+                DiscordUser.objects.filter(
+                    user_id=OuterRef("pk"),
+                    activated__isnull=self.negate_result
+                )
+            )
+        )
+
+    def get_dependencies(self):
+        return []
+
 
 class FilterExpression(FilterBase):
     class Meta:
@@ -152,7 +312,26 @@ class FilterExpression(FilterBase):
 
     negate_result = models.BooleanField(default=False)
 
+    @property
+    def cache_in_cycle(self):
+        try:
+            self.check_terms()
+        except smart_filters.FilterCompileError:
+            return False
+        return all(
+            getattr(term.filter_object, "cache_in_cycle", True)
+            for term in (self.first_term, self.second_term)
+        )
+
     def process_filter(self, user: User):
+        try:
+            return User.objects.filter(pk=user.pk).filter(self.user_q()).exists()
+        except smart_filters.FilterCompileError as e:
+            logger.error(f"Unable to run {self}: {e}")
+            return False
+        except NotImplementedError:
+            pass
+
         first = self.first_term.filter_object.process_filter(user)
         second = self.second_term.filter_object.process_filter(user)
 
@@ -214,8 +393,178 @@ class FilterExpression(FilterBase):
 
         return output
 
+    def clean(self):
+        try:
+            self.check_terms()
+        except smart_filters.FilterCompileError as e:
+            raise ValidationError(str(e))
+
+    def _enter(self, _path):
+        if self.pk is not None and self.pk in _path:
+            raise smart_filters.FilterCycleError(
+                f"Expression '{self.name}' references itself"
+            )
+        _path = _path + (self.pk,)
+        if len(_path) > app_settings.SG_EXPRESSION_MAX_DEPTH:
+            raise smart_filters.FilterDepthError(
+                f"Expression '{self.name}' is nested more than {app_settings.SG_EXPRESSION_MAX_DEPTH} deep"
+            )
+        return _path
+
+    def check_terms(self, _path=()):
+        """
+        Walk the expression tree, raising if it loops back on itself
+        or is nested deeper than `SG_EXPRESSION_MAX_DEPTH`.
+        """
+        _path = self._enter(_path)
+        for term in (self.first_term, self.second_term):
+            if isinstance(term.filter_object, FilterExpression):
+                term.filter_object.check_terms(_path)
+
+    def _term_q(self, term, _path):
+        _filter = term.filter_object
+        if isinstance(_filter, FilterExpression):
+            return _filter.user_q(_path)
+        if not hasattr(_filter, "user_q"):
+            raise NotImplementedError(f"{term} can't be run as a query")
+        return _filter.user_q()
+
+    def user_q(self, _path=()):
+        """
+        Compile the whole AND/OR/XOR/NOT tree below this expression into a
+        single `Q` so the database can evaluate it in one pass.
+        """
+        _path = self._enter(_path)
+
+        first = self._term_q(self.first_term, _path)
+        second = self._term_q(self.second_term, _path)
 
-class AltCorpFilter(FilterBase):
+        if self.operator == self.OperatorChoices.AND:
+            result = first & second
+        elif self.operator == self.OperatorChoices.OR:
+            result = first | second
+        elif self.operator == self.OperatorChoices.XOR:
+            result = first ^ second
+        else:
+            return Q(pk__isnull=True)  # nobody passes
+
+        if self.negate_result:
+            result = ~result
+        return result
+
+    @classmethod
+    def with_related(cls, queryset):
+        return queryset.select_related("first_term", "second_term")
+
+    def get_dependencies(self, _path=()):
+        _path = self._enter(_path)
+        dependencies = []
+        for term in (self.first_term, self.second_term):
+            _filter = term.filter_object
+            if isinstance(_filter, FilterExpression):
+                dependencies += _filter.get_dependencies(_path)
+            elif hasattr(_filter, "get_dependencies"):
+                dependencies += _filter.get_dependencies()
+            else:
+                raise NotImplementedError(f"{term} can't list its dependencies")
+        return dependencies
+
+    def _term_user_ids(self, term, users, _path):
+        _filter = term.filter_object
+        if isinstance(_filter, FilterExpression):
+            return _filter.passing_user_ids(users, _path)
+        return smart_filters.passing_user_ids(_filter, users)
+
+    def passing_user_ids(self, users, _path=()):
+        try:
+            return set(users.filter(self.user_q(_path)).values_list("pk", flat=True))
+        except smart_filters.FilterCompileError as e:
+            logger.error(f"Unable to run {self}: {e}")
+            return set()
+        except NotImplementedError:
+            # one of our terms can't be run as a query, combine them as sets instead
+            pass
+
+        _path = self._enter(_path)
+        first = self._term_user_ids(self.first_term, users, _path)
+        second = self._term_user_ids(self.second_term, users, _path)
+
+        if self.operator == self.OperatorChoices.AND:
+            result = first & second
+        elif self.operator == self.OperatorChoices.OR:
+            result = first | second
+        elif self.operator == self.OperatorChoices.XOR:
+            result = first ^ second
+        else:
+            return set()
+
+        if self.negate_result:
+            result = set(users.values_list("pk", flat=True)) - result
+        return result
+
+
+class ExemptionsMixin:
+    """
+    Shared handling of the `exempt_alliances` and `exempt_corporations` fields.
+    The exempt IDs are loaded once per filter instance and kept per process,
+    a version stamp in the cache tells us when a `m2m_changed` invalidated them.
+    """
+    _exemption_cache = {}
+
+    @classmethod
+    def get_exemptions_version_key(cls) -> str:
+        return f"SG-EXEMPT-{cls._meta.label_lower}-VERSION"
+
+    @classmethod
+    def get_exemptions_version(cls) -> str:
+        key = cls.get_exemptions_version_key()
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, None)
+            version = cache.get(key)
+        return version
+
+    @classmethod
+    def bump_exemptions_version(cls):
+        cache.set(cls.get_exemptions_version_key(), uuid.uuid4().hex, None)
+
+    def get_exemptions(self):
+        """`(alliance_ids, corporation_ids)` as frozensets"""
+        if getattr(self, "_exemptions", None) is None:
+            version = self.get_exemptions_version()
+            key = (self._meta.label_lower, self.pk)
+            cached = self._exemption_cache.get(key)
+            if cached is None or cached[0] != version:
+                cached = (
+                    version,
+                    frozenset(self.exempt_alliances.all().values_list("alliance_id", flat=True)),
+                    frozenset(self.exempt_corporations.all().values_list("corporation_id", flat=True)),
+                )
+                self._exemption_cache[key] = cached
+            self._exemptions = cached[1:]
+        return self._exemptions
+
+    def get_exemption_dependencies(self):
+        exempt_allis, exempt_corps = self.get_exemptions()
+        return (
+            [(FilterDependency.ALLIANCE, a) for a in exempt_allis]
+            + [(FilterDependency.CORPORATION, c) for c in exempt_corps]
+        )
+
+    def exempt_q(self) -> Q:
+        exempt_allis, exempt_corps = self.get_exemptions()
+        return smart_filters.exempt_q(exempt_allis=exempt_allis, exempt_corps=exempt_corps)
+
+    def apply_exemptions(self, users, output):
+        """Pass everyone in an audit `output` whose main is exempt"""
+        _q = self.exempt_q()
+        if _q:
+            for uid in users.filter(_q).values_list("pk", flat=True):
+                output[uid] = {"message": "Exempt", "check": True}
+        return output
+
+
+class AltCorpFilter(ExemptionsMixin, FilterBase):
     class Meta:
         verbose_name = "Smart Filter: Character in Corporation"
         verbose_name_plural = verbose_name
@@ -229,10 +578,11 @@ class AltCorpFilter(FilterBase):
         EveCorporationInfo, related_name="corp_exempt_corporations", blank=True)
 
     def process_filter(self, user: User):
+        exempt_allis, exempt_corps = self.get_exemptions()
         return smart_filters.check_alt_corp_on_account(
             user, self.alt_corp.corporation_id,
-            exempt_allis=self.exempt_alliances.all().values_list("alliance_id", flat=True),
-            exempt_corps=self.exempt_corporations.all().values_list("corporation_id", flat=True)
+            exempt_allis=exempt_allis,
+            exempt_corps=exempt_corps
         )
 
     def audit_filter(self, users):
@@ -246,10 +596,29 @@ class AltCorpFilter(FilterBase):
         output = defaultdict(lambda: {"message": "", "check": False})
         for c, char_list in chars.items():
             output[c] = {"message": ", ".join(char_list), "check": True}
-        return output
+        return self.apply_exemptions(users, output)
+
+    def user_q(self):
+        return Q(
+            Exists(
+                UserAffiliation.objects.filter(
+                    user_id=OuterRef("pk"),
+                    corporation_id=self.alt_corp.corporation_id
+                )
+            )
+        ) | self.exempt_q()
+
+    @classmethod
+    def with_related(cls, queryset):
+        return queryset.select_related("alt_corp")
+
+    def get_dependencies(self):
+        return [
+            (FilterDependency.CORPORATION, self.alt_corp.corporation_id)
+        ] + self.get_exemption_dependencies()
 
 
-class AltAllianceFilter(FilterBase):
+class AltAllianceFilter(ExemptionsMixin, FilterBase):
     class Meta:
         verbose_name = "Smart Filter: Character in Alliance"
         verbose_name_plural = verbose_name
@@ -263,9 +632,10 @@ class AltAllianceFilter(FilterBase):
         EveCorporationInfo, related_name="alli_exempt_corporations", blank=True)
 
     def process_filter(self, user: User):
+        exempt_allis, exempt_corps = self.get_exemptions()
         return smart_filters.check_alt_alli_on_account(user, self.alt_alli.alliance_id,
-                                                       exempt_allis=self.exempt_alliances.all().values_list("alliance_id", flat=True),
-                                                       exempt_corps=self.exempt_corporations.all().values_list("corporation_id", flat=True)
+                                                       exempt_allis=exempt_allis,
+                                                       exempt_corps=exempt_corps
                                                        )
 
     def audit_filter(self, users):
@@ -278,10 +648,29 @@ class AltAllianceFilter(FilterBase):
         output = defaultdict(lambda: {"message": "", "check": False})
         for c, char_list in chars.items():
             output[c] = {"message": ", ".join(char_list), "check": True}
-        return output
+        return self.apply_exemptions(users, output)
+
+    def user_q(self):
+        return Q(
+            Exists(
+                UserAffiliation.objects.filter(
+                    user_id=OuterRef("pk"),
+                    alliance_id=self.alt_alli.alliance_id
+                )
+            )
+        ) | self.exempt_q()
+
+    @classmethod
+    def with_related(cls, queryset):
+        return queryset.select_related("alt_alli")
 
+    def get_dependencies(self):
+        return [
+            (FilterDependency.ALLIANCE, self.alt_alli.alliance_id)
+        ] + self.get_exemption_dependencies()
 
-class UserInGroupFilter(FilterBase):
+
+class UserInGroupFilter(ExemptionsMixin, FilterBase):
     class Meta:
         verbose_name = "Smart Filter: User Has Group"
         verbose_name_plural = verbose_name
@@ -296,10 +685,14 @@ class UserInGroupFilter(FilterBase):
 
     reversed_logic = models.BooleanField(default=False)
 
+    # group membership changes during an update cycle
+    cache_in_cycle = False
+
     def process_filter(self, user: User):
+        exempt_allis, exempt_corps = self.get_exemptions()
         return smart_filters.check_group_on_account(user, self.groups.all(),
-                                                    exempt_allis=self.exempt_alliances.all().values_list("alliance_id", flat=True),
-                                                    exempt_corps=self.exempt_corporations.all().values_list("corporation_id", flat=True)
+                                                    exempt_allis=exempt_allis,
+                                                    exempt_corps=exempt_corps
                                                     )
 
     def audit_filter(self, users):
@@ -309,7 +702,47 @@ class UserInGroupFilter(FilterBase):
             lambda: {"message": "", "check": self.reversed_logic})
         for c in cl:
             chars[c.id] = {"message": "", "check": not self.reversed_logic}
-        return chars
+        return self.apply_exemptions(users, chars)
+
+    def user_q(self):
+        in_group = Q(
+            Exists(
+                User.groups.through.objects.filter(
+                    user_id=OuterRef("pk"),
+                    group__in=self.groups.all()
+                )
+            )
+        )
+        if self.reversed_logic:
+            in_group = ~in_group
+        return in_group | self.exempt_q()
+
+    @classmethod
+    def with_related(cls, queryset):
+        return queryset.prefetch_related("groups")
+
+    def get_dependencies(self):
+        return [
+            (FilterDependency.GROUP, pk) for pk in self.groups.all().values_list("pk", flat=True)
+        ] + self.get_exemption_dependencies()
+
+
+PLAN_VERSION_KEY = "SG-PLAN-VERSION"
+PLAN_TIMEOUT = 60 * 60 * 24
+
+
+def get_plan_key(sg_id, version) -> str:
+    return f"SG-PLAN-{sg_id}-{version}"
+
+
+class SmartGroupPlan(NamedTuple):
+    """
+    Compiled filters of a Smart Group, see `SmartGroup.get_plan`.
+    The filters are shared by everything using the plan so treat them as read only.
+    """
+    smart_group_id: int
+    version: str
+    filters: tuple
 
 
 class SmartGroup(models.Model):
@@ -336,9 +769,70 @@ class SmartGroup(models.Model):
     def __str__(self):
         return "Smart Group: %s" % self.group.name
 
+    _plan_cache = {}
+
+    @staticmethod
+    def get_plan_version() -> str:
+        version = cache.get(PLAN_VERSION_KEY)
+        if version is None:
+            cache.add(PLAN_VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(PLAN_VERSION_KEY)
+        return version
+
+    @staticmethod
+    def bump_plan_version():
+        """
+        Throw away every compiled plan,
+        called when a group, a `SmartFilter` or any filter model changes.
+        """
+        cache.set(PLAN_VERSION_KEY, uuid.uuid4().hex, None)
+
+    def compile_plan(self, version) -> SmartGroupPlan:
+        filters = SmartFilter.resolve_filter_objects(self.filters.all())
+        # load the exemptions of every filter, including the terms of expressions
+        pending = list(filters)
+        seen = set()
+        while pending:
+            sf = pending.pop()
+            if sf.pk in seen:
+                continue
+            seen.add(sf.pk)
+            _filter = sf.filter_object
+            if isinstance(_filter, ExemptionsMixin):
+                _filter.get_exemptions()
+            elif isinstance(_filter, FilterExpression):
+                pending += [_filter.first_term, _filter.second_term]
+        return SmartGroupPlan(self.pk, version, tuple(filters))
+
+    def get_plan(self) -> SmartGroupPlan:
+        """
+        The compiled plan for this group, kept per process and in the cache
+        until `bump_plan_version` is called.
+        """
+        version = self.get_plan_version()
+        plan = self._plan_cache.get(self.pk)
+        if plan is None or plan.version != version:
+            key = get_plan_key(self.pk, version)
+            plan = cache.get(key)
+            if plan is None:
+                plan = self.compile_plan(version)
+                try:
+                    cache.set(key, plan, PLAN_TIMEOUT)
+                except Exception as e:
+                    # third party filters might not pickle, keep it in this process only
+                    logger.debug(f"Unable to cache plan for {self}: {e}")
+            self._plan_cache[self.pk] = plan
+        return plan
+
+    def get_filters(self):
+        """
+        The group's `SmartFilter`s with their filter objects already loaded, from the plan.
+        """
+        return list(self.get_plan().filters)
+
     def run_checks(self, user: User):
         output = []
-        for check in self.filters.all():
+        for check in self.get_filters():
             try:
                 _filter = check.filter_object
                 if _filter is None:
@@ -358,24 +852,27 @@ class SmartGroup(models.Model):
 
     def run_check_on_user(self, user: User):
         output = []
-        for check in self.filters.all():
+        profiler = FilterProfiler()
+        for check in self.get_filters():
             _filter = check.filter_object
             if _filter is None:
                 logger.warning(f"Failed to run filter for {check}")
                 continue  # Skip as this is broken...
             try:
-                test_pass = _filter.audit_filter(
-                    User.objects.filter(pk=user.pk)
-                )
+                with profiler.measure(check, 1):
+                    test_pass = _filter.audit_filter(
+                        User.objects.filter(pk=user.pk)
+                    )
             except Exception as e:
                 try:
                     print(e)
-                    test_pass = {
-                        user.id: {
-                            "message": "",
-                            "check": _filter.process_filter(user)
+                    with profiler.measure(check, 1, fallback=True):
+                        test_pass = {
+                            user.id: {
+                                "message": "",
+                                "check": _filter.process_filter(user)
+                            }
                         }
-                    }
                 except Exception:
                     test_pass = {
                         user.id: {
@@ -391,6 +888,7 @@ class SmartGroup(models.Model):
             _check["message"] = test_pass[user.id]['message']
             _check["filter"] = check
             output.append(_check)
+        profiler.save()
         return output
 
     def process_checks(self, checks):
@@ -400,17 +898,131 @@ class SmartGroup(models.Model):
         return out
 
     def check_user(self, user: User):
-        checks = self.run_check_on_user(user)
-        out = self.process_checks(checks)
+        """
+        Pass/Fail for a single user, cheapest and most likely to fail filters
+        first and stop at the first failure.
+        """
+        users = User.objects.filter(pk=user.pk)
+        # one user timings would skew the bulk costs, so this only reads the stats
+        plan = FilterPlanner(self.get_filters())
+        out = True
+        for check in plan.ordered():
+            _filter = check.filter_object
+            if _filter is None:
+                logger.warning(f"Failed to run filter for {check}")
+                continue  # Skip as this is broken...
+            try:
+                test_pass = user.pk in smart_filters.passing_user_ids(_filter, users)
+            except Exception:
+                try:
+                    test_pass = _filter.process_filter(user)
+                except Exception:
+                    test_pass = False
+                    logger.error(f"Filter Failed {check}")
+            if not test_pass:
+                out = False
+                break
         return out
 
 
+class SmartGroupRun(models.Model):
+    """
+    History of the scheduled updates of a Smart Group, one per run.
+    Stage times are wall seconds, summed over the shards of a sharded run.
+    """
+    MODE_FULL = "full"
+    MODE_SHORT_CIRCUIT = "short_circuit"
+    MODE_CHOICES = [
+        (MODE_FULL, "Every filter on every user"),
+        (MODE_SHORT_CIRCUIT, "Stop at first failure"),
+    ]
+
+    group = models.ForeignKey(SmartGroup, on_delete=models.CASCADE, related_name="runs")
+    started = models.DateTimeField()
+    finished = models.DateTimeField()
+    duration = models.FloatField(default=0)
+
+    mode = models.CharField(max_length=16, choices=MODE_CHOICES, default=MODE_FULL)
+    shards = models.PositiveIntegerField(default=1)
+    fake_run = models.BooleanField(default=False)
+
+    checked = models.PositiveIntegerField(default=0)
+    added = models.PositiveIntegerField(default=0)
+    removed = models.PositiveIntegerField(default=0)
+    pending_removals = models.PositiveIntegerField(default=0)
+    queries = models.PositiveIntegerField(default=0)
+
+    population_time = models.FloatField(default=0)
+    bulk_time = models.FloatField(default=0)
+    loop_time = models.FloatField(default=0)
+    write_time = models.FloatField(default=0)
+    notify_time = models.FloatField(default=0)
+
+    class Meta:
+        default_permissions = ("view",)
+        indexes = [
+            models.Index(fields=["group", "-started"]),
+        ]
+
+    def __str__(self):
+        return f"{self.group} @ {self.started}"
+
+
+class AuditSnapshot(models.Model):
+    """
+    The per filter results of the members of a Smart Group as of its last scheduled update.
+    `results` maps each `User.id` to a `[result, message]` pair per filter in `filters` order,
+    `result` is `None` where the run stopped before it could tell.
+    """
+    group = models.OneToOneField(
+        SmartGroup, on_delete=models.CASCADE, primary_key=True, related_name="audit_snapshot"
+    )
+    created = models.DateTimeField()
+    filters = models.JSONField(default=list)
+    results = models.JSONField(default=dict)
+
+    class Meta:
+        default_permissions = ()
+
+    def __str__(self):
+        return f"{self.group} @ {self.created}"
+
+    def cells(self, filters, user_ids):
+        """
+        The snapshot cells for `user_ids` against `filters`, in the `audit_matrix` format.
+        Users or filters the snapshot doesn't know about are left out.
+        """
+        index = {fid: i for i, fid in enumerate(self.filters)}
+        cells = []
+        for uid in user_ids:
+            row = self.results.get(str(uid))
+            if row is None:
+                continue
+            for f in filters:
+                if f.id not in index:
+                    continue
+                result, message = row[index[f.id]]
+                cells.append({"uid": uid, "fid": f.id, "result": result, "message": message})
+        return cells
+
+
 class GracePeriodRecord(models.Model):
     group = models.ForeignKey(SmartGroup, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     grace_filter = models.ForeignKey(SmartFilter, on_delete=models.CASCADE)
     expires = models.DateTimeField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["group", "user", "grace_filter"],
+                name="securegroups_unique_grace_record",
+            )
+        ]
+        indexes = [
+            models.Index(fields=["expires"]),
+        ]
+
     def __str__(self):
         return "{} - {} - {}".format(self.user, self.group, self.grace_filter)
 
@@ -420,15 +1032,9 @@ class GracePeriodRecord(models.Model):
     def notify_user(self, message):
         # dm user if has discord account and discord bot installed
         if app_settings.discord_bot_active():
-            try:
-                aadiscordbot.tasks.send_direct_message.delay(
-                    self.user.discord.uid, message
-                )
-            except Exception as e:
-                logger.error(e, exc_info=True)
-                pass
-        else:
-            pass
+            from .tasks import queue_discord_messages
+            dm = PendingDiscordMessage(user=self.user, message=message)
+            transaction.on_commit(lambda: queue_discord_messages([dm]))
 
 
 class PendingNotification(models.Model):
@@ -444,7 +1050,9 @@ class PendingNotification(models.Model):
 
     @classmethod
     def get_grace_notifications(cls):
-        notifications = cls.objects.filter(notified=False, removal=False)
+        notifications = cls.objects.filter(
+            notified=False, removal=False
+        ).select_related("user__profile__main_character", "group__group", "filter")
         out = defaultdict(list)
         for n in notifications:
             out[n.user].append(n)
@@ -453,9 +1061,246 @@ class PendingNotification(models.Model):
 
     @classmethod
     def get_kick_notifications(cls):
-        notifications = cls.objects.filter(notified=False, removal=True)
+        notifications = cls.objects.filter(
+            notified=False, removal=True
+        ).select_related("user__profile__main_character", "group__group", "filter")
         out = defaultdict(list)
         for n in notifications:
             out[n.user].append(n)
 
-        return out, notifications
\ No newline at end of file
+        return out, notifications
+
+
+class PendingDiscordMessage(models.Model):
+    """
+    Outbox of Discord DMs, `tasks.send_discord_messages` sends these at a steady rate
+    and keeps failures here to try again later.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    title = models.CharField(max_length=256, blank=True, default="")
+    message = models.TextField()
+    # embed colour, messages without one are sent as plain text
+    color = models.PositiveIntegerField(null=True, blank=True, default=None)
+
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        default_permissions = ()
+        indexes = [
+            models.Index(fields=["next_attempt"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.title}"
+
+
+class UserAffiliation(models.Model):
+    """
+    Denormalized index of the corporations and alliances a user has characters in.
+    Kept up to date from `CharacterOwnership` and `EveCharacter` signals,
+    rebuild it with `manage.py rebuild_securegroup_affiliations`.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    corporation_id = models.PositiveIntegerField()
+    alliance_id = models.PositiveIntegerField(null=True, blank=True, default=None)
+
+    class Meta:
+        default_permissions = ()
+        indexes = [
+            models.Index(fields=["corporation_id", "user"]),
+            models.Index(fields=["alliance_id", "user"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.corporation_id} / {self.alliance_id}"
+
+    @classmethod
+    def _affiliations(cls, ownerships):
+        rows = ownerships.values_list(
+            "user_id", "character__corporation_id", "character__alliance_id"
+        ).order_by().distinct()
+        return [
+            cls(user_id=u, corporation_id=c, alliance_id=a)
+            for u, c, a in set(rows)
+        ]
+
+    @classmethod
+    def refresh_users(cls, user_ids):
+        """Rebuild the rows for a handful of users"""
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        rows = cls._affiliations(
+            CharacterOwnership.objects.filter(user_id__in=user_ids)
+        )
+        with transaction.atomic():
+            cls.objects.filter(user_id__in=user_ids).delete()
+            cls.objects.bulk_create(rows)
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Rebuild the whole index"""
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                cls._affiliations(CharacterOwnership.objects.all()),
+                batch_size=batch_size
+            )
+
+
+class PendingUserCheck(models.Model):
+    """
+    Users that have changed since they were last checked, and the Smart Groups the change can affect.
+    `tasks.run_pending_user_checks` works through these between the full updates.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    smart_group = models.ForeignKey("SmartGroup", on_delete=models.CASCADE, related_name="+")
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        default_permissions = ()
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "smart_group"],
+                name="securegroups_unique_pending_check",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} ({self.smart_group_id}): {self.created}"
+
+    @classmethod
+    def queue(cls, user_ids, smart_group_ids=None):
+        """
+        Add users to the queue for the `smart_group_ids` they can affect, every updated group by default.
+        Anyone already waiting is left as is.
+        """
+        user_ids = set(user_ids) - {None}
+        if not user_ids:
+            return
+        groups = SmartGroup.objects.filter(enabled=True, include_in_updates=True)
+        if smart_group_ids is not None:
+            groups = groups.filter(pk__in=smart_group_ids)
+        cls.objects.bulk_create(
+            [
+                cls(user_id=uid, smart_group_id=sg_id)
+                for sg_id in groups.values_list("pk", flat=True)
+                for uid in user_ids
+            ],
+            ignore_conflicts=True
+        )
+
+    @classmethod
+    def pop(cls, limit=1000):
+        """Take the oldest `limit` checks off the queue, returns the user ids keyed by smart group id"""
+        with transaction.atomic():
+            rows = list(
+                cls.objects.order_by("created").values_list("pk", "smart_group_id", "user_id")[:limit]
+            )
+            cls.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+        checks = defaultdict(set)
+        for _, sg_id, user_id in rows:
+            checks[sg_id].add(user_id)
+        return dict(checks)
+
+
+class FilterDependency(models.Model):
+    """
+    Reverse index of the corporations, alliances and groups each `SmartFilter` looks at,
+    so a change to one only re-checks the Smart Groups that care about it.
+    Filters that can't list their dependencies are left with `SmartFilter.dependencies_indexed` off
+    and are treated as depending on everything.
+    """
+    CORPORATION = "corporation"
+    ALLIANCE = "alliance"
+    GROUP = "group"
+    KIND_CHOICES = (
+        (CORPORATION, "Corporation"),
+        (ALLIANCE, "Alliance"),
+        (GROUP, "Group"),
+    )
+
+    smart_filter = models.ForeignKey(
+        SmartFilter, on_delete=models.CASCADE, related_name="dependencies"
+    )
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES)
+    target_id = models.BigIntegerField()
+
+    class Meta:
+        default_permissions = ()
+        indexes = [
+            models.Index(fields=["kind", "target_id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.smart_filter_id}: {self.kind} {self.target_id}"
+
+    @classmethod
+    def refresh_filters(cls, filters):
+        """
+        Rebuild the rows for some `SmartFilter`s, expressions are always
+        rebuilt too as they take on the dependencies of their terms.
+        """
+        expression_type = ContentType.objects.get_for_model(FilterExpression)
+        to_refresh = {sf.pk: sf for sf in filters}
+        for sf in SmartFilter.objects.filter(content_type=expression_type):
+            to_refresh.setdefault(sf.pk, sf)
+
+        rows = []
+        indexed = set()
+        for sf in SmartFilter.resolve_filter_objects(to_refresh.values()):
+            _filter = sf.filter_object
+            try:
+                dependencies = set(_filter.get_dependencies())
+            except (AttributeError, NotImplementedError, smart_filters.FilterCompileError):
+                continue
+            indexed.add(sf.pk)
+            rows += [
+                cls(smart_filter_id=sf.pk, kind=kind, target_id=target_id)
+                for kind, target_id in dependencies
+                if target_id is not None
+            ]
+        with transaction.atomic():
+            cls.objects.filter(smart_filter_id__in=to_refresh.keys()).delete()
+            cls.objects.bulk_create(rows)
+            SmartFilter.objects.filter(pk__in=indexed).update(dependencies_indexed=True)
+            SmartFilter.objects.filter(
+                pk__in=set(to_refresh.keys()) - indexed
+            ).update(dependencies_indexed=False)
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the whole index"""
+        cls.refresh_filters(SmartFilter.objects.all())
+
+    @classmethod
+    def affected_filters(cls, corporation_ids=(), alliance_ids=(), group_ids=()):
+        """`SmartFilter`s that need re-running after a change to any of these"""
+        _q = Q(dependencies_indexed=False)
+        for kind, ids in (
+            (cls.CORPORATION, corporation_ids),
+            (cls.ALLIANCE, alliance_ids),
+            (cls.GROUP, group_ids),
+        ):
+            ids = set(ids) - {None}
+            if ids:
+                _q |= Q(
+                    pk__in=cls.objects.filter(kind=kind, target_id__in=ids).values("smart_filter_id")
+                )
+        return SmartFilter.objects.filter(_q)
+
+    @classmethod
+    def affected_smart_groups(cls, corporation_ids=(), alliance_ids=(), group_ids=()):
+        """
+        `SmartGroup`s that need re-checking after a change to any of these,
+        eg a corporation moving alliance affects `alliance_ids=[old, new]`.
+        """
+        return SmartGroup.objects.filter(
+            filters__in=cls.affected_filters(
+                corporation_ids=corporation_ids,
+                alliance_ids=alliance_ids,
+                group_ids=group_ids,
+            )
+        ).distinct()
@@ -1,13 +1,23 @@
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
 from typing import Union
 
 from django.contrib.auth.models import Group, User
-from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete, pre_save,
+)
 from django.dispatch import receiver
 
 from allianceauth import hooks
+from allianceauth.authentication.models import CharacterOwnership, UserProfile
+from allianceauth.eveonline.models import EveCharacter
+from allianceauth.groupmanagement.models import GroupRequest
 
 from . import models
+from .tasks import bump_groups_view
 
 # signals go here
 
@@ -64,9 +74,153 @@ def new_group_filter(sender, instance: models.SmartGroup, created, **kwargs):
         logger.error("Bah Humbug")  # we failed! do something here
 
 
+def refresh_filter_dependencies(filter_model, instance=None):
+    try:
+        smart_filters = models.SmartFilter.objects.filter(
+            content_type=ContentType.objects.get_for_model(filter_model)
+        )
+        if isinstance(instance, filter_model):
+            smart_filters = smart_filters.filter(object_id=instance.pk)
+        models.FilterDependency.refresh_filters(smart_filters)
+    except Exception as e:
+        logger.error(f"Failed to update filter dependencies for {filter_model}: {e}", exc_info=True)
+
+
+def plan_changed(*args, **kwargs):
+    models.SmartGroup.bump_plan_version()
+    # and again once committed, in case a worker compiled the old rows in the meantime
+    transaction.on_commit(models.SmartGroup.bump_plan_version)
+
+
+def filter_saved(sender, instance, **kwargs):
+    refresh_filter_dependencies(sender, instance)
+
+
 for _filter in filters.get_hooks():
     post_save.connect(new_filter, sender=_filter)
+    post_save.connect(filter_saved, sender=_filter)
     pre_delete.connect(rem_filter, sender=_filter)
+    post_save.connect(plan_changed, sender=_filter)
+    post_delete.connect(plan_changed, sender=_filter)
+
+for _model in (models.SmartGroup, models.SmartFilter):
+    post_save.connect(plan_changed, sender=_model)
+    post_delete.connect(plan_changed, sender=_model)
+m2m_changed.connect(plan_changed, sender=models.SmartGroup.filters.through)
+
+
+def m2m_changed_exemptions(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        _exemptions[sender].bump_exemptions_version()
+        # and again once committed, in case a worker cached the old rows in the meantime
+        transaction.on_commit(_exemptions[sender].bump_exemptions_version)
+        refresh_filter_dependencies(_exemptions[sender], instance)
+        plan_changed()
+
+
+_exemptions = {}
+for _model in (models.AltCorpFilter, models.AltAllianceFilter, models.UserInGroupFilter):
+    for _field in (_model.exempt_alliances, _model.exempt_corporations):
+        _exemptions[_field.through] = _model
+        m2m_changed.connect(m2m_changed_exemptions, sender=_field.through)
+
+
+@receiver(m2m_changed, sender=models.UserInGroupFilter.groups.through)
+def m2m_changed_filter_groups(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        refresh_filter_dependencies(models.UserInGroupFilter, instance)
+        plan_changed()
+
+
+_trusted_membership = ContextVar("sg_trusted_membership", default=False)
+
+
+@contextmanager
+def trusted_membership():
+    """
+    Group changes made in here have already been checked against the
+    smart group filters so are not validated again on the way in.
+    Every other receiver still gets its signals as normal.
+    """
+    token = _trusted_membership.set(True)
+    try:
+        yield
+    finally:
+        _trusted_membership.reset(token)
+
+
+def queue_user_checks(user_ids, smart_group_ids=None):
+    """Queue users to re-check against `smart_group_ids`, or every updated group"""
+    try:
+        models.PendingUserCheck.queue(user_ids, smart_group_ids)
+    except Exception as e:
+        logger.error(f"Failed to queue user checks: {e}", exc_info=True)
+
+
+def get_affected_smart_group_ids(**kwargs):
+    """Ids of the smart groups `FilterDependency.affected_smart_groups` finds for a change"""
+    return set(
+        models.FilterDependency.affected_smart_groups(**kwargs).values_list("pk", flat=True)
+    )
+
+
+def get_character_smart_group_ids(character_id):
+    """Ids of the smart groups that can care who owns a character, every group if it's gone"""
+    affiliation = EveCharacter.objects.filter(
+        pk=character_id
+    ).values_list("corporation_id", "alliance_id").first()
+    if affiliation is None:
+        return None
+    return get_affected_smart_group_ids(
+        corporation_ids={affiliation[0]}, alliance_ids={affiliation[1]}
+    )
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def m2m_changed_queue_user_checks(sender, instance: Union[User, Group], action, pk_set, *args, **kwargs):
+    # other smart groups can filter on these groups
+    if isinstance(instance, User):
+        if action == "pre_clear":
+            instance._sg_cleared_group_ids = set(instance.groups.values_list("pk", flat=True))
+        elif action in ("post_add", "post_remove", "post_clear"):
+            group_ids = pk_set or getattr(instance, "_sg_cleared_group_ids", set())
+            affected = get_affected_smart_group_ids(group_ids=group_ids)
+            if affected:
+                queue_user_checks({instance.pk}, affected)
+    elif isinstance(instance, Group):
+        if action not in ("post_add", "post_remove", "pre_clear"):
+            return
+        affected = get_affected_smart_group_ids(group_ids={instance.pk})
+        if not affected:
+            return
+        if action in ("post_add", "post_remove"):
+            queue_user_checks(pk_set, affected)
+        elif action == "pre_clear":
+            queue_user_checks(instance.user_set.values_list("pk", flat=True), affected)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def m2m_changed_groups_view(sender, instance: Union[User, Group], action, pk_set, *args, **kwargs):
+    if isinstance(instance, User):
+        if action in ("post_add", "post_remove", "post_clear"):
+            bump_groups_view({instance.pk})
+    elif action in ("post_add", "post_remove"):
+        bump_groups_view(pk_set)
+    elif action == "pre_clear":
+        bump_groups_view(instance.user_set.values_list("pk", flat=True))
+
+
+@receiver(post_save, sender=GroupRequest)
+@receiver(post_delete, sender=GroupRequest)
+def group_request_changed(sender, instance: GroupRequest, **kwargs):
+    bump_groups_view({instance.user_id})
+
+
+@receiver(post_save, sender=models.GracePeriodRecord)
+def grace_saved(sender, instance: models.GracePeriodRecord, **kwargs):
+    # bulk changes made by the updates and deletes from the admin reset the page themselves,
+    # a post_delete here would stop graces being fast deleted
+    bump_groups_view({instance.user_id})
 
 
 @receiver(m2m_changed, sender=User.groups.through)
@@ -74,6 +228,9 @@ def m2m_changed_user_groups(sender, instance: Union[User, Group], action, pk_set
     logger.debug("Received m2m_changed from %s groups with action %s" %
                  (instance, action))
 
+    if _trusted_membership.get():
+        return
+
     if instance.pk and (action == "pre_add"):
         if isinstance(instance, User):
             # Is a user update for all groups added
@@ -99,3 +256,85 @@ def m2m_changed_user_groups(sender, instance: Union[User, Group], action, pk_set
                     )
                     if not sg_check:
                         pk_set.remove(user_pk)
+
+
+@receiver(pre_save, sender=CharacterOwnership)
+def character_ownership_pre_save(sender, instance: CharacterOwnership, **kwargs):
+    # ownership can move between users, keep the old one to refresh it too
+    instance._sg_previous_user_id = None
+    if instance.pk:
+        instance._sg_previous_user_id = CharacterOwnership.objects.filter(
+            pk=instance.pk
+        ).values_list("user_id", flat=True).first()
+
+
+@receiver(post_save, sender=CharacterOwnership)
+def character_ownership_post_save(sender, instance: CharacterOwnership, **kwargs):
+    try:
+        models.UserAffiliation.refresh_users(
+            {instance.user_id, getattr(instance, "_sg_previous_user_id", None)} - {None}
+        )
+    except Exception as e:
+        logger.error(f"Failed to update affiliations for {instance}: {e}", exc_info=True)
+    queue_user_checks(
+        {instance.user_id, getattr(instance, "_sg_previous_user_id", None)},
+        get_character_smart_group_ids(instance.character_id)
+    )
+
+
+@receiver(post_delete, sender=CharacterOwnership)
+def character_ownership_post_delete(sender, instance: CharacterOwnership, **kwargs):
+    try:
+        models.UserAffiliation.refresh_users({instance.user_id})
+    except Exception as e:
+        logger.error(f"Failed to update affiliations for {instance}: {e}", exc_info=True)
+    queue_user_checks({instance.user_id}, get_character_smart_group_ids(instance.character_id))
+
+
+@receiver(pre_save, sender=EveCharacter)
+def eve_character_pre_save(sender, instance: EveCharacter, **kwargs):
+    instance._sg_previous_affiliation = None
+    if instance.pk:
+        instance._sg_previous_affiliation = EveCharacter.objects.filter(
+            pk=instance.pk
+        ).values_list("corporation_id", "alliance_id").first()
+
+
+@receiver(post_save, sender=EveCharacter)
+def eve_character_post_save(sender, instance: EveCharacter, **kwargs):
+    previous = getattr(instance, "_sg_previous_affiliation", None)
+    if previous == (instance.corporation_id, instance.alliance_id):
+        return
+    previous = previous or (None, None)
+    user_ids = set(
+        CharacterOwnership.objects.filter(
+            character=instance
+        ).values_list("user_id", flat=True)
+    )
+    try:
+        models.UserAffiliation.refresh_users(user_ids)
+    except Exception as e:
+        logger.error(f"Failed to update affiliations for {instance}: {e}", exc_info=True)
+    affected = get_affected_smart_group_ids(
+        corporation_ids={previous[0], instance.corporation_id},
+        alliance_ids={previous[1], instance.alliance_id},
+    )
+    if affected:
+        queue_user_checks(user_ids, affected)
+
+
+@receiver(pre_save, sender=UserProfile)
+def user_profile_pre_save(sender, instance: UserProfile, **kwargs):
+    instance._sg_previous_profile = None
+    if instance.pk:
+        instance._sg_previous_profile = UserProfile.objects.filter(
+            pk=instance.pk
+        ).values_list("state_id", "main_character_id").first()
+
+
+@receiver(post_save, sender=UserProfile)
+def user_profile_post_save(sender, instance: UserProfile, **kwargs):
+    previous = getattr(instance, "_sg_previous_profile", None)
+    if previous != (instance.state_id, instance.main_character_id):
+        queue_user_checks({instance.user_id})
+        bump_groups_view({instance.user_id})
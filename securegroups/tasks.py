@@ -1,20 +1,30 @@
+import hashlib
 import json
 import logging
+import time
+import uuid
+from collections import defaultdict
 from datetime import timedelta
 
 import requests
-from celery import chain, shared_task
+from celery import chain, chord, group as celery_group, shared_task
 
+from django.apps import apps
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.db import connection, transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from allianceauth.notifications import notify
 
-from . import app_settings
+from . import app_settings, filter as smart_filters
 from .models import (
-    GracePeriodRecord, GroupUpdateWebhook, PendingNotification, SmartGroup,
+    AuditSnapshot, GracePeriodRecord, GroupUpdateWebhook, PendingDiscordMessage,
+    PendingNotification, PendingUserCheck, SmartFilter, SmartGroup,
+    SmartGroupRun,
 )
+from .planner import FilterPlanner, FilterProfiler
 
 if app_settings.discord_bot_active():
     import aadiscordbot
@@ -24,66 +34,369 @@ if app_settings.discord_bot_active():
 
 logger = logging.getLogger(__name__)
 
+# users are streamed from the database in chunks of this size during an update
+USER_CHUNK_SIZE = 2000
 
-def create_pending_notification(user, message, group, filter, remove=False):
+
+def create_pending_notification(user, message, group, filter, remove=False, pending=None):
+    """
+    `user` can be a `User` or the `User.id`.
+    Pass a list in `pending` to collect the notification for `save_grace_changes`.
+    """
     logger.info(
         f"Adding {group} to {user} pending notifications for {message}"
     )
-    PendingNotification.objects.create(
-        user=user,
+    notification = PendingNotification(
+        user_id=getattr(user, "pk", user),
         filter=filter,
         group=group,
         message=message,
         removal=remove
     )
+    if pending is not None:
+        pending.append(notification)
+    else:
+        notification.save()
+
+
+def chunks(items, chunk_size):
+    items = list(items)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def save_grace_changes(
+    smart_group, new_graces, expired_ids, cleared_user_ids, notifications, chunk_size=500
+):
+    """
+    Write the grace records and notifications collected during an update,
+    one transaction per chunk.
+    """
+    for _ids in chunks(cleared_user_ids, chunk_size):
+        with transaction.atomic():
+            GracePeriodRecord.objects.filter(
+                group=smart_group, user_id__in=_ids
+            ).delete()
+    for _ids in chunks(expired_ids, chunk_size):
+        with transaction.atomic():
+            GracePeriodRecord.objects.filter(pk__in=_ids).delete()
+    for _graces in chunks(new_graces, chunk_size):
+        with transaction.atomic():
+            # already graced for this filter is fine, keep the first one
+            GracePeriodRecord.objects.bulk_create(_graces, ignore_conflicts=True)
+    for _notifications in chunks(notifications, chunk_size):
+        with transaction.atomic():
+            PendingNotification.objects.bulk_create(_notifications)
+    # expired graces end in a removal, which resets the page on its own
+    bump_groups_view(set(cleared_user_ids) | {g.user_id for g in new_graces})
+
+
+DM_LOCK_KEY = "SG-DISCORD-DM-LOCK"
+DM_LOCK_TIMEOUT = 60 * 5
+DM_BUCKET_KEY = "SG-DISCORD-DM-BUCKET"
+DM_MAX_ATTEMPTS = 5
+# a sent message with no word back from the bot by then is tried again
+DM_CONFIRM_TIMEOUT = 60 * 15
+
+
+def send_discord_dm(user, title, message, color, pending=None):
+    """
+    Queue a Discord DM in the outbox, `send_discord_messages` sends it.
+    Pass a list in `pending` to collect it for `queue_discord_messages` instead.
+    """
+    if app_settings.discord_bot_active():
+        dm = PendingDiscordMessage(
+            user_id=getattr(user, "pk", user),
+            title=title,
+            message=message,
+            color=getattr(color, "value", color)
+        )
+        if pending is None:
+            queue_discord_messages([dm])
+        else:
+            pending.append(dm)
 
 
-def send_discord_dm(user, title, message, color):
-    if app_settings.discord_bot_active():
+def queue_discord_messages(messages):
+    if messages:
+        PendingDiscordMessage.objects.bulk_create(messages, batch_size=500)
+        send_discord_messages.delay()
+
+
+def get_discord_user_ids(user_ids) -> dict:
+    """
+    `User.id` to Discord id for everyone in `user_ids` we can DM,
+    in one query when AA's Discord service is installed.
+    """
+    user_ids = set(user_ids)
+    if apps.is_installed("allianceauth.services.modules.discord"):
+        from allianceauth.services.modules.discord.models import DiscordUser
+        return dict(
+            DiscordUser.objects.filter(user_id__in=user_ids).values_list("user_id", "uid")
+        )
+    discord_ids = {}
+    for user in User.objects.filter(pk__in=user_ids):
         try:
-            e = Embed(
-                title=title,
-                description=message,
-                color=color
-            )
+            discord_ids[user.pk] = get_discord_user_id(user)
+        except NotAuthenticated:
+            pass
+    return discord_ids
+
+
+def deliver_discord_dm(dm, discord_id):
+    """
+    Hand `dm` to the bot, it reports back to `discord_message_sent` once discord took it,
+    or to `discord_message_failed` when the bot gave up on it.
+    """
+    embed = None
+    if dm.color is not None:
+        embed = Embed(title=dm.title, description=dm.message, color=Color(dm.color)).to_dict()
+    aadiscordbot.tasks.send_direct_message_by_discord_id.apply_async(
+        args=(discord_id, "" if embed else dm.message, embed),
+        link=discord_message_sent.si(dm.pk),
+        link_error=discord_message_failed.si(dm.pk),
+    )
+
+
+class TokenBucket:
+    """
+    Calls to `take` average no more than `rate` a second, after an initial `burst`
+    that can go back to back. `take` doesn't block, it returns how many seconds until
+    the next token instead. `save` keeps what's left in the cache for the next run.
+    """
+
+    def __init__(self, key, rate, burst):
+        self.key = key
+        self.rate = rate
+        self.capacity = burst
+        self.tokens, self.updated = cache.get(key, (burst, time.time()))
+
+    def take(self) -> float:
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def save(self):
+        # once it would have filled up again there is nothing to remember
+        cache.set(self.key, (self.tokens, self.updated), self.capacity / self.rate + 60)
+
+
+@shared_task
+def send_discord_messages():
+    """
+    Hand the Discord DM outbox to the bot at `SG_DISCORD_DM_PER_MINUTE`.
+    Messages stay in the outbox until the bot confirms them, failures are tried
+    again with a backoff, up to `DM_MAX_ATTEMPTS` times.
+    """
+    if not app_settings.discord_bot_active():
+        return
+    if not cache.add(DM_LOCK_KEY, True, DM_LOCK_TIMEOUT):
+        return  # someone else is already sending
+
+    wait = 0
+    try:
+        bucket = TokenBucket(
+            DM_BUCKET_KEY, app_settings.SG_DISCORD_DM_PER_MINUTE / 60, app_settings.SG_DISCORD_DM_BURST
+        )
+        due = list(
+            PendingDiscordMessage.objects.filter(
+                next_attempt__lte=timezone.now()
+            ).order_by("created")[:app_settings.SG_DISCORD_DM_PER_MINUTE]
+        )
+        discord_ids = get_discord_user_ids(dm.user_id for dm in due)
+
+        done = []
+        sent = []
+        for dm in due:
+            discord_id = discord_ids.get(dm.user_id)
+            if discord_id is None:
+                logger.warning(f"Unable to ping {dm.user_id} - {dm.message}")
+                done.append(dm.pk)
+                continue
+            wait = bucket.take()
+            if wait:
+                break  # out of budget, pick up from here once there is a token
+            # in flight until the bot reports back, or sent again if it never does
+            dm.attempts += 1
+            dm.next_attempt = timezone.now() + timedelta(seconds=DM_CONFIRM_TIMEOUT)
+            dm.save(update_fields=["attempts", "next_attempt"])
             try:
-                aadiscordbot.tasks.send_message(
-                    user_id=get_discord_user_id(user),
-                    embed=e
-                )
-                logger.info(
-                    f"sent discord ping to {user} - {message}"
-                )
-            except NotAuthenticated:
-                logger.warning(f"Unable to ping {user} - {message}")
+                deliver_discord_dm(dm, discord_id)
+                sent.append(dm.pk)
+            except Exception as e:
+                discord_message_failed(dm.pk, e)
+        bucket.save()
+
+        PendingDiscordMessage.objects.filter(pk__in=done).delete()
+        if sent:
+            logger.info(f"Handed {len(sent)} discord pings to the bot")
+    finally:
+        cache.delete(DM_LOCK_KEY)
+
+    if wait:
+        send_discord_messages.apply_async(countdown=wait)
+    elif PendingDiscordMessage.objects.filter(next_attempt__lte=timezone.now()).exists():
+        send_discord_messages.delay()
+    else:
+        retry = PendingDiscordMessage.objects.order_by("next_attempt").first()
+        if retry:
+            send_discord_messages.apply_async(
+                countdown=(retry.next_attempt - timezone.now()).total_seconds()
+            )
 
+
+@shared_task
+def discord_message_sent(message_id):
+    """The bot delivered it, it can leave the outbox."""
+    PendingDiscordMessage.objects.filter(pk=message_id).delete()
+
+
+@shared_task
+def discord_message_failed(message_id, error=None):
+    """The bot couldn't deliver it, back off and try again up to `DM_MAX_ATTEMPTS` times."""
+    dm = PendingDiscordMessage.objects.filter(pk=message_id).first()
+    if dm is None:
+        return
+    if dm.attempts >= DM_MAX_ATTEMPTS:
+        logger.error(f"Giving up on discord ping to {dm.user_id}: {error}")
+        dm.delete()
+        return
+    logger.warning(f"Discord ping to {dm.user_id} failed, will retry: {error}")
+    backoff = 60 * 2 ** dm.attempts
+    dm.next_attempt = timezone.now() + timedelta(seconds=backoff)
+    dm.save(update_fields=["next_attempt"])
+    send_discord_messages.apply_async(countdown=backoff)
+
+
+# discord won't take more than this in one message
+WEBHOOK_MAX_LENGTH = 2000
+# (connect, read) seconds
+WEBHOOK_TIMEOUT = (5, 15)
+WEBHOOK_MAX_RETRIES = 5
+
+_webhook_session = None
+
+
+def get_webhook_session():
+    """One pooled session per worker process, so posts reuse connections."""
+    global _webhook_session
+    if _webhook_session is None:
+        _webhook_session = requests.Session()
+        _webhook_session.headers.update({"Content-Type": "application/json"})
+    return _webhook_session
+
+
+def split_webhook_messages(messages, max_length=WEBHOOK_MAX_LENGTH):
+    """Join `messages` into as few posts as will fit under `max_length` each."""
+    posts = []
+    current = ""
+    for message in messages:
+        while len(message) > max_length:
+            if current:
+                posts.append(current)
+                current = ""
+            posts.append(message[:max_length])
+            message = message[max_length:]
+        if current and len(current) + len(message) + 1 > max_length:
+            posts.append(current)
+            current = ""
+        current = f"{current}\n{message}" if current else message
+    if current:
+        posts.append(current)
+    return posts
+
+
+def get_webhook_retry_after(response, retries) -> float:
+    """Seconds to wait before trying again, from `Retry-After` if discord sent one."""
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        return float(response.json()["retry_after"])
+    except Exception:
+        return 5 * 2 ** retries
+
+
+@shared_task(bind=True, max_retries=WEBHOOK_MAX_RETRIES)
+def send_webhook_messages(self, url, messages):
+    """
+    Post `messages` to a webhook in as few posts as possible.
+    Rate limits and server errors are retried with whatever hasn't been sent yet.
+    """
+    session = get_webhook_session()
+    posts = split_webhook_messages(messages)
+    for i, content in enumerate(posts):
+        try:
+            r = session.post(
+                url,
+                data=json.dumps({"content": content}),
+                timeout=WEBHOOK_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            logger.warning(f"Webhook post failed, retrying: {e}")
+            raise self.retry(
+                args=[url, posts[i:]], countdown=5 * 2 ** self.request.retries
+            )
+        logger.debug(
+            f"Got status code {r.status_code} after sending ping"
+        )
+        if r.status_code == 429 or r.status_code >= 500:
+            countdown = get_webhook_retry_after(r, self.request.retries)
+            logger.warning(f"Webhook returned {r.status_code}, retrying in {countdown}s")
+            raise self.retry(args=[url, posts[i:]], countdown=countdown)
+        try:
+            r.raise_for_status()
         except Exception as e:
             logger.error(e, exc_info=1)
-            pass
 
 
-def send_update_to_webhook(group, update):
+def get_webhook_queue_key(cycle_id) -> str:
+    return f"SG-CYCLE-{cycle_id}-WEBHOOKS"
+
+
+def queue_webhook_message(cycle_id, url, content):
+    """Hold a message until `flush_webhook_messages` at the end of the cycle."""
+    key = get_webhook_queue_key(cycle_id)
+    cache.add(key, 0, CYCLE_CACHE_TIMEOUT)
+    idx = cache.incr(key)
+    cache.set(f"{key}-{idx}", (url, content), CYCLE_CACHE_TIMEOUT)
+
+
+@shared_task
+def flush_webhook_messages(cycle_id):
+    """Send everything held for a cycle, one combined dispatch per webhook."""
+    key = get_webhook_queue_key(cycle_id)
+    total = cache.get(key, 0)
+    keys = [f"{key}-{i}" for i in range(1, total + 1)]
+    queued = cache.get_many(keys)
+    messages = defaultdict(list)
+    for k in keys:  # keep them in order
+        if k in queued:
+            url, content = queued[k]
+            messages[url].append(content)
+    cache.delete_many(keys + [key])
+    for url, contents in messages.items():
+        send_webhook_messages.delay(url, contents)
+
+
+def send_update_to_webhook(group, update, cycle_id=None):
+    """
+    Send an update to the group's webhooks in the background,
+    inside a cycle they are held and sent together at the end.
+    """
     group_hook = GroupUpdateWebhook.objects.filter(
         group_id=group, enabled=True)
-    if group_hook.exists():
-        for grp in group_hook:
-            custom_headers = {"Content-Type": "application/json"}
-            r = requests.post(
-                grp.webhook,
-                headers=custom_headers,
-                data=json.dumps(
-                    {
-                        "content": f"{update}\n{grp.extra_message}"
-                    }
-                ),
-            )
-            logger.debug(
-                f"Got status code {r.status_code} after sending ping"
-            )
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                logger.error(e, exc_info=1)
+    for grp in group_hook:
+        content = f"{update}\n{grp.extra_message}"
+        if cycle_id:
+            queue_webhook_message(cycle_id, grp.webhook, content)
+        else:
+            send_webhook_messages.delay(grp.webhook, [content])
 
 
 CACHE_TIMEOUT = 60 * 60 * 4
@@ -105,44 +418,257 @@ def clear_failure(sg_id, user_id):
     cache.delete(get_failure_key(sg_id, user_id))
 
 
-def process_grace(smart_group, all_users):
-    output = {}
+def get_failures(sg_id, user_ids, chunk_size=1000) -> set:
+    """The `User.id`s from `user_ids` that failed last time, one `get_many` per chunk"""
+    failures = set()
+    for _ids in chunks(user_ids, chunk_size):
+        keys = {get_failure_key(sg_id, uid): uid for uid in _ids}
+        failures.update(keys[k] for k, v in cache.get_many(keys.keys()).items() if v)
+    return failures
 
-    _all_graced_members = GracePeriodRecord.objects.filter(
-        group=smart_group, user__username__in=all_users
+
+def set_failures(sg_id, user_ids, chunk_size=1000):
+    for _ids in chunks(user_ids, chunk_size):
+        cache.set_many(
+            {get_failure_key(sg_id, uid): True for uid in _ids}, CACHE_TIMEOUT
+        )
+
+
+def clear_failures(sg_id, user_ids, chunk_size=1000):
+    for _ids in chunks(user_ids, chunk_size):
+        cache.delete_many([get_failure_key(sg_id, uid) for uid in _ids])
+
+
+GROUPS_VIEW_TIMEOUT = 60 * 10
+
+
+def get_groups_view_version_key(user_id) -> str:
+    return f"SG-GROUPS-VIEW-VERSION-{user_id}"
+
+
+def get_groups_view_key(user_id) -> str:
+    """
+    Cache key for a user's groups page, changes when `bump_groups_view` is called
+    for them or any Smart Group or filter changes.
+    """
+    version_key = get_groups_view_version_key(user_id)
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, GROUPS_VIEW_TIMEOUT)
+        version = cache.get(version_key)
+    return f"SG-GROUPS-VIEW-{user_id}-{version}-{SmartGroup.get_plan_version()}"
+
+
+def bump_groups_view(user_ids):
+    """
+    Throw away the cached groups page of these users, after a request, grace or membership change.
+    """
+    cache.delete_many([get_groups_view_version_key(uid) for uid in set(user_ids) - {None}])
+
+
+CYCLE_CACHE_TIMEOUT = 60 * 60 * 2
+
+
+def get_cycle_key(cycle_id, filter_id, fingerprint) -> str:
+    return f"SG-CYCLE-{cycle_id}-{filter_id}-{fingerprint}-RESULTS"
+
+
+def get_cycle_index_key(cycle_id) -> str:
+    return f"SG-CYCLE-{cycle_id}-RESULTS"
+
+
+def get_population_fingerprint(user_ids) -> str:
+    """
+    Hash of a set of `User.id`s, groups that run the same filter
+    over the same users in a cycle can share the result.
+    """
+    _hash = hashlib.sha1()
+    for pk in sorted(user_ids):
+        _hash.update(f"{pk},".encode())
+    return _hash.hexdigest()
+
+
+def get_cycle_result(cycle_id, filter_id, fingerprint):
+    return cache.get(get_cycle_key(cycle_id, filter_id, fingerprint))
+
+
+def set_cycle_result(cycle_id, filter_id, fingerprint, passing):
+    """
+    Share a result with the rest of the cycle, the first group to finish it wins.
+    Every result has its own key so groups running in parallel can't overwrite each other.
+    """
+    key = get_cycle_key(cycle_id, filter_id, fingerprint)
+    if cache.add(key, passing, CYCLE_CACHE_TIMEOUT):
+        # remember the key for `clear_cycle_results`
+        index = get_cycle_index_key(cycle_id)
+        cache.add(index, 0, CYCLE_CACHE_TIMEOUT)
+        cache.set(f"{index}-{cache.incr(index)}", key, CYCLE_CACHE_TIMEOUT)
+
+
+@shared_task
+def clear_cycle_results(cycle_id):
+    index = get_cycle_index_key(cycle_id)
+    index_keys = [f"{index}-{i}" for i in range(1, cache.get(index, 0) + 1)]
+    cache.delete_many(
+        list(cache.get_many(index_keys).values()) + index_keys + [index]
     )
 
-    if smart_group.can_grace:
-        for gm in _all_graced_members:
-            if gm.user.username not in output:
-                output[gm.user.username] = {}
-            output[gm.user.username][gm.grace_filter] = gm
 
-    return output
+def process_grace(smart_group, members):
+    """
+    Grace ledger for `members`, `(User.id, SmartFilter.id)` to `(GracePeriodRecord.id, expires)`.
+    """
+    if not smart_group.can_grace:
+        return {}
+    records = GracePeriodRecord.objects.filter(
+        group=smart_group, user__in=members
+    ).values("pk", "user_id", "grace_filter_id", "expires")
+    return {
+        (r["user_id"], r["grace_filter_id"]): (r["pk"], r["expires"])
+        for r in records
+    }
+
 
+def process_users_in_bulk(
+    smart_group, users, cycle_id=None, short_circuit=False, profiler=None, filters=None, checked=None
+):
+    """
+    Run every filter on the group against `users` in bulk.
+    Returns the set of passing `User.id`s keyed by `SmartFilter.id`,
+    filters that fail are left out and get checked one user at a time.
+
+    Inside a `run_smart_groups` cycle results are shared with any other
+    group that runs the same filter over the same users.
+
+    Filters run in `FilterPlanner` order. With `short_circuit` each filter only
+    checks the users that passed everything before it, so the per filter results
+    are only good for the overall pass/fail. Don't use it when grace needs them.
+
+    Every call is measured by `profiler`, saved here unless one is passed in.
+    `filters` are the group's already resolved filters, loaded if not given.
+    Pass a dict in `checked` to collect the `User.id`s each filter actually ran on.
+    """
+    save_profile = profiler is None
+    profiler = profiler or FilterProfiler()
+    population = set(users.values_list("pk", flat=True))
+    fingerprint = None
+    if cycle_id:
+        fingerprint = get_population_fingerprint(population)
 
-def process_users_in_bulk(smart_group, users):
     bulk_checks = {}
-    filters = smart_group.filters.all()
+    remaining = set(population)
+    narrowed = users
+    if checked is None:
+        checked = {}
+
+    if filters is None:
+        filters = smart_group.get_filters()
+    pending = []
     for f in filters:
         try:
-            bulk_checks[f.id] = f.filter_object.audit_filter(users)
-        except Exception:
-            pass
+            if cycle_id and getattr(f.filter_object, "cache_in_cycle", True):
+                passing = get_cycle_result(cycle_id, f.id, fingerprint)
+                if passing is not None:
+                    logger.debug(f"Using cycle result for {f}")
+                    bulk_checks[f.id] = passing
+                    checked[f.id] = population
+                    remaining &= passing
+                    continue
+        except Exception as e:
+            logger.error(f"Bulk check failed for {f}: {e}")
+        pending.append(f)
+
+    plan = FilterPlanner(pending)
+    for f in plan.ordered():
+        if short_circuit and not remaining:
+            bulk_checks[f.id] = set()  # everyone has already failed
+            checked[f.id] = set()
+            continue
+        try:
+            _filter = f.filter_object
+            run_on = narrowed if short_circuit else users
+            run_for = set(remaining) if short_circuit else population
+            with profiler.measure(f, len(run_for)):
+                passing = smart_filters.passing_user_ids(_filter, run_on)
+            profiler.failures(f, len(run_for), len(run_for) - len(passing & remaining))
+            bulk_checks[f.id] = passing
+            checked[f.id] = run_for
+            remaining &= passing
+            if run_on is users and cycle_id and getattr(_filter, "cache_in_cycle", True):
+                set_cycle_result(cycle_id, f.id, fingerprint, passing)
+        except Exception as e:
+            logger.error(f"Bulk check failed for {f}: {e}")
+            continue
+
+        if short_circuit:
+            # let the database skip anyone that has already failed
+            try:
+                narrowed = narrowed.filter(_filter.user_q())
+            except (AttributeError, NotImplementedError, smart_filters.FilterCompileError):
+                pass
+    if save_profile:
+        profiler.save()
     return bulk_checks
 
 
-def process_user(filter, user, bulk_checks=None):
+def process_messages_in_bulk(smart_group, bulk_checks, user_ids, profiler=None, filters=None, checked=None):
+    """
+    Fetch the audit messages for the users in `user_ids` that failed a bulk check.
+    Only these users are ever notified so there is no need to build messages for everyone.
+    With the `checked` from a short circuited `process_users_in_bulk` each filter
+    only gets messages for the users it actually ran on.
+    """
+    save_profile = profiler is None
+    profiler = profiler or FilterProfiler()
+    if filters is None:
+        filters = smart_group.get_filters()
+    bulk_messages = {}
+    for f in filters:
+        if f.id not in bulk_checks:
+            continue
+        failed = set(user_ids) - bulk_checks[f.id]
+        if checked is not None:
+            failed &= checked.get(f.id, set())
+        if not failed:
+            continue
+        try:
+            with profiler.measure(f, len(failed)):
+                bulk_messages[f.id] = f.filter_object.audit_filter(
+                    User.objects.filter(pk__in=failed)
+                )
+        except Exception as e:
+            logger.error(f"Failed to get audit messages for {f}: {e}")
+    if save_profile:
+        profiler.save()
+    return bulk_messages
+
+
+def process_user(filter, user, bulk_checks=None, bulk_messages=None, profiler=None):
+    """
+    `user` can be a `User` or just the `User.id`, the full user is only
+    loaded if we have to fall back to checking them on their own.
+    Fallbacks are measured by `profiler` when one is passed in.
+    """
+    user_id = getattr(user, "pk", user)
     _c = {
         "name": filter.filter_object.description,
         "filter": filter
     }
     try:
-        _c["check"] = bulk_checks[filter.id][user.id]['check']
-        _c["message"] = bulk_checks[filter.id][user.id]['message']
+        _c["check"] = user_id in bulk_checks[filter.id]
+        try:
+            _c["message"] = bulk_messages[filter.id][user_id]['message']
+        except Exception:
+            _c["message"] = ""
     except Exception:
         try:
-            _c["check"] = filter.filter_object.process_filter(user)
+            if not isinstance(user, User):
+                user = User.objects.get(pk=user_id)
+            if profiler is None:
+                _c["check"] = filter.filter_object.process_filter(user)
+            else:
+                with profiler.measure(filter, 1, fallback=True):
+                    _c["check"] = filter.filter_object.process_filter(user)
             _c["message"] = ""
         except Exception:
             _c["check"] = False
@@ -150,16 +676,62 @@ def process_user(filter, user, bulk_checks=None):
     return _c
 
 
-def check_user_has_main(smart_group, user, fake_run):
+def get_audit_cell(check, evaluated=True):
+    """
+    The `[result, message]` of one `process_user` check for the audit snapshot,
+    `[None, ""]` when a short circuited update never ran the filter on the user.
+    """
+    if not evaluated:
+        return [None, ""]
+    return [check["check"], check.get("message", "")]
+
+
+def audit_matrix(smart_group, filters, user_ids, chunk_size=250):
+    """
+    Every user in `user_ids` against every one of `filters`, using the bulk checks.
+    Yields a list of `{"uid", "fid", "result", "message"}` cells per chunk of users,
+    messages are only fetched for the users that fail.
+    """
+    profiler = FilterProfiler()
+    for _ids in chunks(user_ids, chunk_size):
+        users = User.objects.filter(pk__in=_ids)
+        bulk_checks = process_users_in_bulk(
+            smart_group, users, profiler=profiler, filters=filters
+        )
+        bulk_messages = process_messages_in_bulk(
+            smart_group, bulk_checks, _ids, profiler=profiler, filters=filters
+        )
+        cells = []
+        for uid in _ids:
+            for f in filters:
+                _c = process_user(f, uid, bulk_checks, bulk_messages, profiler=profiler)
+                cells.append({
+                    "uid": uid,
+                    "fid": f.id,
+                    "result": _c["check"],
+                    "message": _c["message"],
+                })
+        yield cells
+    profiler.save()
+
+
+def check_user_has_main(smart_group, user, fake_run, removals=None):
+    """
+    False if the user has no main, they get removed from the group.
+    Pass a set in `removals` to collect the `User.id` for a bulk removal instead.
+    """
     try:
         assert user.profile.main_character is not None
         return True
     except Exception:  # no main character kickeroo!
         if not fake_run:
-            user.groups.remove(smart_group.group)
             # remove user
+            if removals is not None:
+                removals.add(user.id)
+            else:
+                user.groups.remove(smart_group.group)
+            message = f'{user.username} - Removed from "{smart_group.group.name}" No Main'
             if smart_group.notify_on_remove:
-                message = f'{user.username} - Removed from "{smart_group.group.name}" No Main'
                 notify(
                     user,
                     f'Auto Group Removal "{smart_group.group.name}"',
@@ -170,22 +742,45 @@ def check_user_has_main(smart_group, user, fake_run):
         return False
 
 
-@shared_task
-def run_smart_group_update(sg_id, can_grace=False, fake_run=False):
-    # Run Smart Group and add/remove members as required
-    smart_group = SmartGroup.objects.get(id=sg_id)
-    if smart_group.can_grace:
-        can_grace = smart_group.can_grace
+def remove_user_without_main(smart_group, user_id, username, fake_run, removals):
+    """
+    `check_user_has_main` for a streamed user we already know has no main,
+    their `User.id` is collected in `removals` and the `User` only loaded to notify them.
+    """
+    if fake_run:
+        return
+    removals.add(user_id)
+    message = f'{username} - Removed from "{smart_group.group.name}" No Main'
+    if smart_group.notify_on_remove:
+        notify(
+            User.objects.get(pk=user_id),
+            f'Auto Group Removal "{smart_group.group.name}"',
+            message,
+            "warning"
+        )
+    logger.info(message)
 
-    logger.info(
-        f"Starting '{smart_group.group.name}' Checks. {'(Fake)' if fake_run else ''}"
-    )
 
-    group = smart_group.group
-    all_users = group.user_set.all().values_list("username", flat=True)
-    all_graced_members = process_grace(smart_group, all_users)
+def update_group_members(group, add_ids, remove_ids, chunk_size=1000):
+    """
+    Bulk add and remove `User.id`s on a group.
+    The ids have already been through the filters so the join check is skipped,
+    services still get their `m2m_changed` for every user.
+    """
+    from .signals import trusted_membership
+
+    with transaction.atomic(), trusted_membership():
+        for _ids in chunks(remove_ids, chunk_size):
+            group.user_set.remove(*_ids)
+        for _ids in chunks(add_ids, chunk_size):
+            group.user_set.add(*_ids)
 
-    # who are we going to process?
+
+def get_smart_group_users(smart_group):
+    """
+    Everyone a smart group update has to check.
+    """
+    group = smart_group.group
     if smart_group.auto_group:
         states = group.authgroup.states.all()
         if states.count() > 0:
@@ -196,27 +791,231 @@ def run_smart_group_update(sg_id, can_grace=False, fake_run=False):
                 profile__main_character__isnull=False)
     else:
         users = group.user_set.all()
+    return users
+
+
+def get_shard_bounds(users, shard_size):
+    """
+    Split `users` into `User.id` ranges of around `shard_size` users.
+    The first and last ranges are open ended so between them they cover every id.
+    """
+    ids = list(users.order_by("pk").values_list("pk", flat=True).distinct())
+    starts = ids[::shard_size]
+    bounds = []
+    for i, lo in enumerate(starts):
+        hi = starts[i + 1] - 1 if i + 1 < len(starts) else None
+        bounds.append((lo if i else None, hi))
+    return bounds
+
+
+def filter_id_range(users, min_id=None, max_id=None):
+    if min_id is not None:
+        users = users.filter(pk__gte=min_id)
+    if max_id is not None:
+        users = users.filter(pk__lte=max_id)
+    return users
+
+
+RUN_LEASE_TIMEOUT = 60 * 15
+# long enough to dedupe a burst of refreshes, short enough not to outlive a lost task
+RUN_QUEUED_TIMEOUT = 60 * 5
+
+
+def get_run_lease_key(sg_id) -> str:
+    return f"SG-RUN-LEASE-{sg_id}"
+
+
+def get_run_queued_key(sg_id) -> str:
+    return f"SG-RUN-QUEUED-{sg_id}"
+
+
+class RunLease:
+    """
+    Cache lease that stops two updates of a Smart Group running at once.
+
+    Queueing an update only sets a short lived marker so repeat requests are merged,
+    the lease itself is claimed by the first task of the update to start. Every task of
+    that update claims it again with the same `run_id`, renewing it as a heartbeat while it works.
+    If a worker dies the lease runs out after `RUN_LEASE_TIMEOUT`.
+    """
+
+    def __init__(self, sg_id, run_id=None):
+        self.sg_id = sg_id
+        self.run_id = run_id or uuid.uuid4().hex
+        self.key = get_run_lease_key(sg_id)
+        self.queued_key = get_run_queued_key(sg_id)
+        self._renewed = 0
+
+    def queue(self) -> bool:
+        """
+        Mark an update as queued, False if one is already queued or running.
+        """
+        if self.is_held(self.sg_id):
+            return False
+        return cache.add(self.queued_key, self.run_id, RUN_QUEUED_TIMEOUT)
+
+    def claim(self) -> bool:
+        """
+        Take the lease or renew it if it is already ours, False if another run holds it.
+        """
+        if cache.add(self.key, self.run_id, RUN_LEASE_TIMEOUT):
+            # running now, a new request can queue the next one
+            self._clear_queued()
+            self._renewed = time.monotonic()
+            return True
+        if cache.get(self.key) == self.run_id and cache.touch(self.key, RUN_LEASE_TIMEOUT):
+            self._renewed = time.monotonic()
+            return True
+        return False
 
-    users = users.select_related(
-        "profile",
-        "profile__main_character"
-    ).distinct()
+    def renew(self):
+        # cheap enough to call per user, only goes to the cache every minute
+        if time.monotonic() - self._renewed > 60:
+            self.claim()
+
+    def release(self):
+        self._clear_queued()
+        if cache.get(self.key) == self.run_id:
+            cache.delete(self.key)
+
+    def _clear_queued(self):
+        if cache.get(self.queued_key) == self.run_id:
+            cache.delete(self.queued_key)
+
+    @staticmethod
+    def is_held(sg_id) -> bool:
+        return cache.get(get_run_lease_key(sg_id)) is not None
+
+
+@shared_task
+def release_run_leases(leases):
+    """
+    Errback for failed updates, frees the `(sg_id, run_id)` leases and queued markers
+    they left behind so the next update of those groups isn't skipped.
+    """
+    for sg_id, run_id in leases:
+        RunLease(sg_id, run_id).release()
+
+
+class RunTimer:
+    """
+    Wall time per stage of an update, each `lap` is charged to the stage named.
+    Used as a context manager it also counts the queries made inside it.
+    """
+
+    def __init__(self):
+        self.started = timezone.now()
+        self.timings = defaultdict(float)
+        self.queries = 0
+        self._last = time.perf_counter()
+        self._wrapper = None
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] += now - self._last
+        self._last = now
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._wrapper.__exit__(*exc)
+
+
+def evaluate_smart_group(
+    smart_group, users, can_grace=False, fake_run=False, cycle_id=None, members=None, timer=None,
+    lease=None, track_failures=True
+):
+    """
+    Check `users` against the smart group and save any grace changes.
+    Returns the verdict for `apply_smart_group_update`, the users to add and remove and the counts.
+    `members` is the current members to consider, defaults to all of them.
+    `lease` is renewed as we go.
+    Without `track_failures` the two-strike flags are left alone, so nobody gets a grace
+    that only the scheduled updates can confirm.
+    """
+    timer = timer or RunTimer()
+    profiler = FilterProfiler()
+    sg_id = smart_group.id
+    group = smart_group.group
+    if members is None:
+        members = group.user_set.all()
+    all_users = set(members.values_list("pk", flat=True))
+    grace_ledger = process_grace(smart_group, members)
+    all_graced_members = {uid for uid, _ in grace_ledger}
+    now = timezone.now()
+
+    users = users.distinct()
+    filters = smart_group.get_filters()
+
+    # grace works per filter so needs every filter run over every user,
+    # otherwise we only care if they pass them all and can stop early
+    needs_full = bool(all_graced_members) or (
+        can_grace and any(f.grace_period > 0 for f in filters)
+    )
+    timer.lap("population")
+    checked = {}
+    bulk_checks = process_users_in_bulk(
+        smart_group,
+        users,
+        cycle_id=cycle_id,
+        short_circuit=not needs_full,
+        profiler=profiler,
+        filters=filters,
+        checked=checked
+    )
+    # the members that fail need their messages for the notifications and the audit snapshot
+    bulk_messages = process_messages_in_bulk(
+        smart_group,
+        bulk_checks,
+        all_users,
+        profiler=profiler,
+        filters=filters,
+        checked=checked
+    )
 
-    bulk_checks = process_users_in_bulk(smart_group, users)
+    # members that might fail, everyone else is sure to pass the bulk checks
+    maybe_failing = set(all_users)
+    if filters and all(f.id in bulk_checks for f in filters):
+        maybe_failing -= set.intersection(*(bulk_checks[f.id] for f in filters))
+    failures = get_failures(sg_id, maybe_failing) if track_failures and not fake_run else set()
+    set_failed = set()
+    clear_failed = set()
+    timer.lap("bulk")
 
     count = 0
     added = 0
     removed = 0
     pending_removals = 0
-    for u in users:
-        if not check_user_has_main(smart_group, u, fake_run):
+    to_add = []
+    to_remove = set()
+    new_graces = []
+    expired_graces = []
+    cleared_graces = []
+    notifications = []
+    audit = {}
+    # stream just what we need, full users are only loaded for the odd one that needs it
+    rows = users.values_list(
+        "pk", "username", "profile__main_character__character_name"
+    ).iterator(chunk_size=USER_CHUNK_SIZE)
+    for uid, username, main_character_name in rows:
+        if lease is not None:
+            lease.renew()
+        has_main = main_character_name is not None
+        if not has_main:
+            remove_user_without_main(smart_group, uid, username, fake_run, to_remove)
             removed += 1
             continue
         checks = []
 
-        filters = smart_group.filters.all()
         for f in filters:
-            _c = process_user(f, u, bulk_checks)
+            _c = process_user(f, uid, bulk_checks, bulk_messages, profiler=profiler)
             checks.append(_c)
 
         if len(checks) == 0:
@@ -232,51 +1031,46 @@ def run_smart_group_update(sg_id, can_grace=False, fake_run=False):
                 check_pass = False
                 reasons.append(f'{c.get("name", "")}  {c.get("message", "")}')
 
+        if uid in all_users or (check_pass and smart_group.auto_group):
+            audit[uid] = [
+                get_audit_cell(c, evaluated=c["filter"].id not in checked or uid in checked[c["filter"].id])
+                for c in checks
+            ]
+
         if check_pass:
-            if u.username in all_graced_members:
+            if uid in all_graced_members:
                 if not fake_run:
-                    GracePeriodRecord.objects.filter(
-                        user=u, group=smart_group).delete()
+                    cleared_graces.append(uid)
             if smart_group.auto_group:
-                if u.username not in all_users:
+                if uid not in all_users:
                     # Add user
                     added += 1
                     if not fake_run:
-                        u.groups.add(group)
-                        message = f"{u.profile.main_character.character_name} - Passed the requirements for {group.name}"
-                        if smart_group.notify_on_add:
-                            if app_settings.discord_bot_active():
-                                send_discord_dm(
-                                    u,
-                                    f'Auto Group Added "{group.name}"',
-                                    message,
-                                    Color.blue()
-                                )
-                            notify(
-                                u, f'Auto Group Added "{group.name}"', message, "info")
-                        logger.info(message)
+                        to_add.append(uid)
 
         else:
-            if u.username in all_users:
+            if uid in all_users:
                 remove = False
                 grace = False
                 was_graced = False
                 for c in checks:
                     filter_name = c.get("filter")
                     grace_days = filter_name.grace_period
-                    expires = timezone.now() + timedelta(days=grace_days)
-                    if u.username in all_graced_members:
-                        if filter_name in all_graced_members.get(u.username, {}):
-                            if all_graced_members[u.username][filter_name].is_expired():
+                    expires = now + timedelta(days=grace_days)
+                    if uid in all_graced_members:
+                        if (uid, filter_name.id) in grace_ledger:
+                            grace_pk, grace_expires = grace_ledger[(uid, filter_name.id)]
+                            if grace_expires < now:
                                 if smart_group.notify_on_remove:
                                     create_pending_notification(
-                                        u,
+                                        uid,
                                         c.get("message", ""),
                                         smart_group,
                                         c.get("filter"),
-                                        remove=True
+                                        remove=True,
+                                        pending=notifications
                                     )
-                                all_graced_members[u.username][filter_name].delete()
+                                expired_graces.append(grace_pk)
                                 remove = True
                                 continue
                             else:
@@ -284,19 +1078,20 @@ def run_smart_group_update(sg_id, can_grace=False, fake_run=False):
                         elif not c.get("check", False):
                             if can_grace and grace_days > 0:
                                 grace = True
-                                if not fake_run and get_failure(sg_id, u.id):
-                                    GracePeriodRecord.objects.create(
-                                        user=u,
+                                if not fake_run and uid in failures:
+                                    new_graces.append(GracePeriodRecord(
+                                        user_id=uid,
                                         group=smart_group,
                                         grace_filter=filter_name,
                                         expires=expires,
-                                    )
+                                    ))
                                     if smart_group.notify_on_grace:
                                         create_pending_notification(
-                                            u,
+                                            uid,
                                             c.get("message", ""),
                                             smart_group,
-                                            c.get("filter")
+                                            c.get("filter"),
+                                            pending=notifications
                                         )
                             else:
                                 remove = True
@@ -304,19 +1099,20 @@ def run_smart_group_update(sg_id, can_grace=False, fake_run=False):
                     elif not c.get("check", False):
                         if can_grace and grace_days > 0:
                             grace = True
-                            if not fake_run and get_failure(sg_id, u.id):
-                                GracePeriodRecord.objects.create(
-                                    user=u,
+                            if not fake_run and uid in failures:
+                                new_graces.append(GracePeriodRecord(
+                                    user_id=uid,
                                     group=smart_group,
                                     grace_filter=filter_name,
                                     expires=expires,
-                                )
+                                ))
                                 if smart_group.notify_on_grace:
                                     create_pending_notification(
-                                        u,
+                                        uid,
                                         c.get("message", ""),
                                         smart_group,
-                                        c.get("filter")
+                                        c.get("filter"),
+                                        pending=notifications
                                     )
                         else:
                             remove = True
@@ -324,17 +1120,146 @@ def run_smart_group_update(sg_id, can_grace=False, fake_run=False):
                 if remove:
                     removed += 1
                     if not fake_run:
-                        u.groups.remove(group)
+                        to_remove.add(uid)
                 elif grace:
                     pending_removals += 1
                     if not fake_run:
-                        if get_failure(sg_id, u.id):
-                            clear_failure(sg_id, u.id)
+                        if uid in failures:
+                            clear_failed.add(uid)
                         else:
-                            set_failure(sg_id, u.id)
+                            set_failed.add(uid)
                 elif was_graced:
                     pending_removals += 1
 
+    timer.lap("loop")
+    save_grace_changes(
+        smart_group, new_graces, expired_graces, cleared_graces, notifications
+    )
+    if track_failures:
+        clear_failures(sg_id, clear_failed)
+        set_failures(sg_id, set_failed)
+    profiler.save()
+    timer.lap("write")
+
+    return {
+        "checked": count,
+        "added": added,
+        "removed": removed,
+        "pending_removals": pending_removals,
+        "to_add": to_add,
+        "to_remove": sorted(to_remove),
+        "mode": SmartGroupRun.MODE_FULL if needs_full else SmartGroupRun.MODE_SHORT_CIRCUIT,
+        "started": timer.started.isoformat(),
+        "timings": dict(timer.timings),
+        "queries": timer.queries,
+        "audit_filters": [f.id for f in filters],
+        "audit": audit,
+    }
+
+
+def record_smart_group_run(smart_group, verdicts, timer, fake_run=False):
+    """
+    Save the `SmartGroupRun` for an update from its verdicts and the timer of the apply step,
+    runs older than `SG_RUN_HISTORY_DAYS` are dropped.
+    """
+    timings = defaultdict(float, timer.timings)
+    for v in verdicts:
+        for stage, seconds in v.get("timings", {}).items():
+            timings[stage] += seconds
+    started = min(
+        [parse_datetime(v["started"]) for v in verdicts if v.get("started")] or [timer.started]
+    )
+    finished = timezone.now()
+    modes = {v.get("mode") for v in verdicts}
+    run = SmartGroupRun.objects.create(
+        group=smart_group,
+        started=started,
+        finished=finished,
+        duration=(finished - started).total_seconds(),
+        mode=SmartGroupRun.MODE_FULL if SmartGroupRun.MODE_FULL in modes else SmartGroupRun.MODE_SHORT_CIRCUIT,
+        shards=len(verdicts),
+        fake_run=fake_run,
+        checked=sum(v["checked"] for v in verdicts),
+        added=sum(v["added"] for v in verdicts),
+        removed=sum(v["removed"] for v in verdicts),
+        pending_removals=sum(v["pending_removals"] for v in verdicts),
+        queries=timer.queries + sum(v.get("queries", 0) for v in verdicts),
+        population_time=timings["population"],
+        bulk_time=timings["bulk"],
+        loop_time=timings["loop"],
+        write_time=timings["write"],
+        notify_time=timings["notify"],
+    )
+    SmartGroupRun.objects.filter(
+        group=smart_group,
+        started__lt=finished - timedelta(days=app_settings.SG_RUN_HISTORY_DAYS)
+    ).delete()
+    return run
+
+
+def record_audit_snapshot(smart_group, verdicts):
+    """
+    Save the results of the members after an update as the group's `AuditSnapshot`,
+    so the audit screens don't need to run every filter again.
+    """
+    verdicts = [v for v in verdicts if "audit" in v]
+    if not verdicts:
+        return None
+    members = set(smart_group.group.user_set.values_list("pk", flat=True))
+    results = {}
+    for v in verdicts:
+        for uid, row in v["audit"].items():
+            if int(uid) in members:
+                results[str(uid)] = row
+    snapshot, _ = AuditSnapshot.objects.update_or_create(
+        group=smart_group,
+        defaults={
+            "created": timezone.now(),
+            "filters": verdicts[0]["audit_filters"],
+            "results": results,
+        }
+    )
+    return snapshot
+
+
+def apply_smart_group_update(smart_group, verdicts, fake_run=False, report=True, cycle_id=None, timer=None):
+    """
+    Merge the verdicts from `evaluate_smart_group`, update the members and report it.
+    `report` sends the summary to the group webhooks and saves the run history.
+    """
+    timer = timer or RunTimer()
+    group = smart_group.group
+    count = sum(v["checked"] for v in verdicts)
+    added = sum(v["added"] for v in verdicts)
+    removed = sum(v["removed"] for v in verdicts)
+    pending_removals = sum(v["pending_removals"] for v in verdicts)
+    to_add = [uid for v in verdicts for uid in v["to_add"]]
+    to_remove = [uid for v in verdicts for uid in v["to_remove"]]
+
+    if to_add or to_remove:
+        update_group_members(group, to_add, to_remove)
+    timer.lap("write")
+
+    to_add = User.objects.filter(pk__in=to_add).select_related(
+        "profile__main_character"
+    )
+    dms = []
+    for u in to_add:
+        message = f"{u.profile.main_character.character_name} - Passed the requirements for {group.name}"
+        if smart_group.notify_on_add:
+            if app_settings.discord_bot_active():
+                send_discord_dm(
+                    u,
+                    f'Auto Group Added "{group.name}"',
+                    message,
+                    Color.blue(),
+                    pending=dms
+                )
+            notify(
+                u, f'Auto Group Added "{group.name}"', message, "info")
+        logger.info(message)
+    queue_discord_messages(dms)
+
     message = "**{group_name}**: Checked {checked} Members, Approved {approved}, Added {added}, Removed {removed} (Pending Removals {pending_removal}){fake}".format(
         checked=count,
         added=added,
@@ -348,18 +1273,227 @@ def run_smart_group_update(sg_id, can_grace=False, fake_run=False):
 
     logger.info(message)
 
-    send_update_to_webhook(group, message)
+    if report:
+        send_update_to_webhook(group, message, cycle_id=cycle_id)
+    timer.lap("notify")
 
     # cleanup graces
-    GracePeriodRecord.objects.filter(
+    stale_graces = GracePeriodRecord.objects.filter(
         group=smart_group
     ).exclude(
         user__in=group.user_set.all()
-    ).delete()
+    )
+    stale_user_ids = set(stale_graces.values_list("user_id", flat=True))
+    if stale_user_ids:
+        stale_graces.delete()
+        bump_groups_view(stale_user_ids)
+    timer.lap("write")
+
+    if report:
+        record_smart_group_run(smart_group, verdicts, timer, fake_run=fake_run)
+        record_audit_snapshot(smart_group, verdicts)
 
     return message
 
 
+@shared_task
+def run_smart_group_update(sg_id, can_grace=False, fake_run=False, cycle_id=None, run_id=None):
+    # Run Smart Group and add/remove members as required
+    smart_group = SmartGroup.objects.get(id=sg_id)
+    if smart_group.can_grace:
+        can_grace = smart_group.can_grace
+
+    lease = RunLease(sg_id, run_id)
+    if not lease.claim():
+        message = f"'{smart_group.group.name}' is already being updated, skipping"
+        logger.info(message)
+        return message
+
+    logger.info(
+        f"Starting '{smart_group.group.name}' Checks. {'(Fake)' if fake_run else ''}"
+    )
+
+    try:
+        with RunTimer() as timer:
+            verdict = evaluate_smart_group(
+                smart_group,
+                get_smart_group_users(smart_group),
+                can_grace=can_grace,
+                fake_run=fake_run,
+                cycle_id=cycle_id,
+                timer=timer,
+                lease=lease
+            )
+        lease.renew()
+        with RunTimer() as timer:
+            return apply_smart_group_update(
+                smart_group, [verdict], fake_run=fake_run, cycle_id=cycle_id, timer=timer
+            )
+    finally:
+        lease.release()
+
+
+@shared_task
+def run_smart_group_shard(
+    sg_id, min_id=None, max_id=None, can_grace=False, fake_run=False, cycle_id=None, run_id=None
+):
+    # Check one User.id range of a Smart Group, the members are updated by finish_smart_group_update
+    smart_group = SmartGroup.objects.get(id=sg_id)
+    if smart_group.can_grace:
+        can_grace = smart_group.can_grace
+
+    lease = RunLease(sg_id, run_id)
+    if not lease.claim():
+        logger.info(f"'{smart_group.group.name}' is already being updated, skipping shard")
+        return None
+
+    logger.info(
+        f"Starting '{smart_group.group.name}' Checks for users {min_id} to {max_id}. {'(Fake)' if fake_run else ''}"
+    )
+
+    with RunTimer() as timer:
+        return evaluate_smart_group(
+            smart_group,
+            filter_id_range(get_smart_group_users(smart_group), min_id, max_id),
+            can_grace=can_grace,
+            fake_run=fake_run,
+            cycle_id=cycle_id,
+            members=filter_id_range(smart_group.group.user_set.all(), min_id, max_id),
+            timer=timer,
+            lease=lease
+        )
+
+
+@shared_task
+def finish_smart_group_update(verdicts, sg_id, fake_run=False, cycle_id=None, run_id=None):
+    smart_group = SmartGroup.objects.get(id=sg_id)
+    lease = RunLease(sg_id, run_id)
+    # skipped shards come back as None
+    verdicts = [v for v in verdicts if v is not None]
+    if not verdicts or not lease.claim():
+        message = f"'{smart_group.group.name}' is already being updated, skipping"
+        logger.info(message)
+        return message
+    try:
+        with RunTimer() as timer:
+            return apply_smart_group_update(
+                smart_group, verdicts, fake_run=fake_run, cycle_id=cycle_id, timer=timer
+            )
+    finally:
+        lease.release()
+
+
+def get_update_signature(smart_group, cycle_id=None, queued=None):
+    """
+    Celery signature to update a Smart Group, `None` if an update is already running or queued.
+    Groups with more than `SG_UPDATE_SHARD_SIZE` users to check are split over a chord of shards.
+    Pass a list in `queued` to collect the `(sg_id, run_id)` for `release_run_leases`.
+    """
+    lease = RunLease(smart_group.id)
+    if not lease.queue():
+        logger.info(f"'{smart_group.group.name}' is already queued or running")
+        return None
+    if queued is not None:
+        queued.append((smart_group.id, lease.run_id))
+
+    shard_size = app_settings.SG_UPDATE_SHARD_SIZE
+    if shard_size:
+        bounds = get_shard_bounds(get_smart_group_users(smart_group), shard_size)
+        if len(bounds) > 1:
+            logger.info(f"Splitting '{smart_group.group.name}' into {len(bounds)} shards")
+            return chord(
+                [
+                    run_smart_group_shard.si(
+                        smart_group.id, lo, hi, cycle_id=cycle_id, run_id=lease.run_id
+                    )
+                    for lo, hi in bounds
+                ],
+                finish_smart_group_update.s(smart_group.id, cycle_id=cycle_id, run_id=lease.run_id)
+            )
+    return run_smart_group_update.si(smart_group.id, cycle_id=cycle_id, run_id=lease.run_id)
+
+
+def recheck_users(smart_group, user_ids):
+    """
+    Re-check a handful of users against a smart group,
+    membership changes are applied without a webhook report.
+    Failures here don't count as a strike, that's left to the scheduled updates.
+    Returns None without checking anyone if an update of the group holds its `RunLease`.
+    """
+    lease = RunLease(smart_group.id)
+    if not lease.claim():
+        logger.info(f"'{smart_group.group.name}' is being updated, skipping the re-check")
+        return None
+    try:
+        verdict = evaluate_smart_group(
+            smart_group,
+            get_smart_group_users(smart_group).filter(pk__in=user_ids),
+            can_grace=smart_group.can_grace,
+            members=smart_group.group.user_set.filter(pk__in=user_ids),
+            lease=lease,
+            track_failures=False
+        )
+        if verdict["to_add"] or verdict["to_remove"]:
+            apply_smart_group_update(smart_group, [verdict], report=False)
+    finally:
+        lease.release()
+    return verdict
+
+
+@shared_task
+def run_pending_user_checks(limit=1000):
+    """
+    Re-check the users that changed since the last run against the groups the change affects,
+    the full `run_smart_groups` update still catches anything missed.
+    """
+    checks = PendingUserCheck.pop(limit)
+    if not checks:
+        return
+
+    groups = SmartGroup.objects.filter(
+        pk__in=checks.keys(), enabled=True, include_in_updates=True
+    ).select_related("group")
+    for smart_group in groups:
+        logger.info(
+            f"Checking {len(checks[smart_group.pk])} changed users for '{smart_group.group.name}'"
+        )
+        try:
+            if recheck_users(smart_group, checks[smart_group.pk]) is None:
+                # try again next time, after the update that holds the group
+                PendingUserCheck.queue(checks[smart_group.pk], [smart_group.pk])
+        except Exception as e:
+            logger.error(f"Failed checking changed users for {smart_group}: {e}", exc_info=True)
+
+
+@shared_task
+def process_expired_graces():
+    """
+    Re-check everyone whose grace has run out so they don't wait for the next full update.
+    Anyone still failing is removed, anyone that fixed it has their grace cleared.
+    Groups being updated are left for the next sweep.
+    """
+    expired = GracePeriodRecord.objects.filter(
+        expires__lt=timezone.now(),
+        group__enabled=True,
+        group__can_grace=True,
+    ).values_list("group_id", "user_id").distinct()
+
+    users = defaultdict(set)
+    for group_id, user_id in expired:
+        users[group_id].add(user_id)
+    if not users:
+        return
+
+    for smart_group in SmartGroup.objects.filter(pk__in=users.keys()).select_related("group"):
+        logger.info(
+            f"Checking {len(users[smart_group.pk])} expired graces for '{smart_group.group.name}'"
+        )
+        try:
+            recheck_users(smart_group, users[smart_group.pk])
+        except Exception as e:
+            logger.error(f"Failed checking expired graces for {smart_group}: {e}", exc_info=True)
+
+
 @shared_task
 def run_smart_groups(only_hidden=False):
 
@@ -368,17 +1502,50 @@ def run_smart_groups(only_hidden=False):
     if only_hidden:
         groups = groups.filter(auto_group=True)
 
+    # filter results are shared between the groups in this cycle
+    cycle_id = uuid.uuid4().hex
+
     sig_list = []
+    queued = []
     for g in groups:
-        sig_list.append(run_smart_group_update.si(g.id))
-
-    sig_list.append(notify_users.si())
-
-    chain(sig_list).apply_async(priority=5)
+        sig = get_update_signature(g, cycle_id=cycle_id, queued=queued)
+        if sig is not None:
+            sig_list.append(sig)
+
+    finish = [
+        notify_users.si(),
+        flush_webhook_messages.si(cycle_id),
+        clear_cycle_results.si(cycle_id),
+    ]
+    # a failed group stops the rest, still post what the others reported
+    # and free the groups that will now never run
+    errbacks = [
+        flush_webhook_messages.si(cycle_id),
+        clear_cycle_results.si(cycle_id),
+        release_run_leases.si(queued),
+    ]
+
+    if app_settings.SG_PARALLEL_UPDATES and sig_list:
+        # deal the groups out over the lanes, each lane runs its groups in order
+        lanes = [[] for _ in range(max(1, min(app_settings.SG_PARALLEL_UPDATE_LANES, len(sig_list))))]
+        for i, sig in enumerate(sig_list):
+            lanes[i % len(lanes)].append(sig)
+        logger.info(f"Running {len(sig_list)} Smart Groups in {len(lanes)} lanes")
+        workflow = chord(
+            celery_group(chain(lane) for lane in lanes),
+            chain(finish)
+        )
+    else:
+        workflow = chain(sig_list + finish)
+    for errback in errbacks:
+        workflow.on_error(errback)
+    workflow.apply_async(priority=5)
 
 
 def notify_grace():
     users, mdls = PendingNotification.get_grace_notifications()
+    SmartFilter.resolve_filter_objects(m.filter for msgs in users.values() for m in msgs)
+    dms = []
     for u, msgs in users.items():
         groups = set()
         messages = set()
@@ -409,13 +1576,17 @@ def notify_grace():
                 u,
                 "Pending Removal",
                 message,
-                Color.orange()
+                Color.orange(),
+                pending=dms
             )
+    queue_discord_messages(dms)
     mdls.update(notified=True)
 
 
 def notify_removal():
     users, mdls = PendingNotification.get_kick_notifications()
+    SmartFilter.resolve_filter_objects(m.filter for msgs in users.values() for m in msgs)
+    dms = []
     for u, msgs in users.items():
         groups = set()
         messages = set()
@@ -446,8 +1617,10 @@ def notify_removal():
                 u,
                 "Group Removal",
                 message,
-                Color.red()
+                Color.red(),
+                pending=dms
             )
+    queue_discord_messages(dms)
     mdls.update(notified=True)
 
 
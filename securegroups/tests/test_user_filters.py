@@ -1,7 +1,14 @@
+import json
 from datetime import timedelta
+from importlib import import_module
+from unittest.mock import patch
 
+from django.apps import apps as django_apps
+from django.contrib.admin.sites import site as admin_site
 from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.db.models.signals import m2m_changed
 from django.test import RequestFactory, TestCase
 from django.urls import reverse
@@ -11,12 +18,14 @@ from allianceauth.authentication.models import CharacterOwnership
 from allianceauth.eveonline.models import (
     EveAllianceInfo, EveCharacter, EveCorporationInfo,
 )
+from allianceauth.groupmanagement.models import GroupRequest
 from allianceauth.tests.auth_utils import AuthUtils
 
 from .. import (
-    filter as gb_filters, models as gb_models, signals as gb_signals,
-    tasks as gb_tasks,
+    admin as gb_admin, app_settings as gb_app_settings, filter as gb_filters, models as gb_models,
+    signals as gb_signals, tasks as gb_tasks, views as gb_views,
 )
+from ..planner import STATS_SMOOTHING, FilterPlanner
 
 
 class TestGroupBotFilters(TestCase):
@@ -119,9 +128,13 @@ class TestGroupBotFilters(TestCase):
                                                alliance_name="Test Alliance 1",
                                                alliance_ticker="TSTA1",
                                                executor_corp_id=3)
-        cls.alli_filter = gb_models.AltAllianceFilter.objects
+        cls.alli_filter = gb_models.AltAllianceFilter.objects.create(
+            name="Test Alliance 1 Alt", description="Have Alt in TSTA1", alt_alli_id=_alli.pk
+        )
 
-        cls.grp_filter = gb_models.UserInGroupFilter.objects
+        cls.grp_filter = gb_models.UserInGroupFilter.objects.create(
+            name="Test Group", description="Test Group"
+        )
         cls.grp_filter.groups.add(cls.test_group)
         cls.grp_filter.groups.add(cls.test_group_2)
 
@@ -132,10 +145,16 @@ class TestGroupBotFilters(TestCase):
         cls.grp_filter_inverted.groups.add(cls.test_group)
         cls.grp_filter_inverted.groups.add(cls.test_group_2)
 
-        cls.grp_filter_single = gb_models.UserInGroupFilter.objects
+        cls.grp_filter_single = gb_models.UserInGroupFilter.objects.create(
+            name="Test Group Single", description="Test Group Single"
+        )
 
         cls.grp_filter_single.groups.add(cls.test_group_2)
 
+    def setUp(self):
+        # compiled plans outlive the rolled back data of the last test
+        gb_models.SmartGroup.bump_plan_version()
+
     def test_user_alt_corp(self):
         users = {}
         for user in User.objects.all():
@@ -178,6 +197,32 @@ class TestGroupBotFilters(TestCase):
         self.assertFalse(tests[9]['check'])
         self.assertFalse(tests[10]['check'])
 
+    def test_user_affiliation_index(self):
+        self.assertEqual(
+            set(
+                gb_models.UserAffiliation.objects.filter(
+                    user_id=6
+                ).values_list("corporation_id", "alliance_id")
+            ),
+            {(1, None), (3, 1)}
+        )
+
+        # alt moves corp
+        character = EveCharacter.objects.get(character_id=11)
+        character.corporation_id = 3
+        character.save()
+        self.assertFalse(gb_filters.check_alt_corp_on_account(User.objects.get(pk=1), 2))
+        self.assertEqual(self.corp_filter.passing_user_ids(User.objects.all()), {2, 3, 4, 5})
+
+        # alt leaves the account
+        CharacterOwnership.objects.get(character__character_id=12).delete()
+        self.assertEqual(self.corp_filter.passing_user_ids(User.objects.all()), {3, 4, 5})
+
+        gb_models.UserAffiliation.objects.all().delete()
+        gb_models.UserAffiliation.rebuild()
+        self.assertEqual(self.corp_filter.passing_user_ids(User.objects.all()), {3, 4, 5})
+        self.assertEqual(self.alli_filter.passing_user_ids(User.objects.all()), {6, 7, 8, 9, 10})
+
     def test_user_alt_alli(self):
         users = {}
         for user in User.objects.all():
@@ -402,6 +447,276 @@ class TestGroupBotFilters(TestCase):
         self.assertTrue(tests[9]['check'])
         self.assertTrue(tests[10]['check'])
 
+    def test_user_alt_corp_passing_ids(self):
+        tests = self.corp_filter.passing_user_ids(User.objects.all())
+
+        self.assertEqual(tests, {1, 2, 3, 4, 5})
+
+    def test_user_alt_corp_passing_ids_exempt(self):
+        _corp = EveCorporationInfo.objects.create(
+            corporation_id=1,
+            corporation_name="Test Corp 1",
+            corporation_ticker="TST1",
+            member_count=100,
+        )
+        self.corp_filter.exempt_corporations.add(_corp)
+        tests = self.corp_filter.passing_user_ids(User.objects.all())
+
+        self.assertEqual(tests, set(range(1, 11)))
+
+        audit = self.corp_filter.audit_filter(User.objects.all())
+        self.assertTrue(audit[7]["check"])
+        self.assertEqual(audit[7]["message"], "Exempt")
+
+        # a fresh instance picks up the change from the cache version
+        self.corp_filter.exempt_corporations.remove(_corp)
+        corp_filter = gb_models.AltCorpFilter.objects.get(pk=self.corp_filter.pk)
+        self.assertEqual(
+            corp_filter.passing_user_ids(User.objects.all()),
+            {1, 2, 3, 4, 5}
+        )
+        self.assertFalse(corp_filter.process_filter(User.objects.get(pk=7)))
+
+    def test_user_alt_corp_exemptions_cached(self):
+        self.corp_filter.get_exemptions()
+        corp_filter = gb_models.AltCorpFilter.objects.get(pk=self.corp_filter.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(corp_filter.get_exemptions(), (frozenset(), frozenset()))
+
+    def test_user_alt_corp_exemptions_bumped_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.corp_filter.exempt_corporations.add(
+                EveCorporationInfo.objects.get(corporation_id=2)
+            )
+            during = gb_models.AltCorpFilter.get_exemptions_version()
+        self.assertNotEqual(gb_models.AltCorpFilter.get_exemptions_version(), during)
+
+    def test_user_alt_alli_passing_ids(self):
+        tests = self.alli_filter.passing_user_ids(User.objects.all())
+
+        self.assertEqual(tests, {6, 7, 8, 9, 10})
+
+    def test_user_group_filter_passing_ids(self):
+        self.disconnect_signals()
+        User.objects.get(id=1).groups.add(self.test_group)
+        User.objects.get(id=7).groups.add(self.test_group_2)
+        self.connect_signals()
+
+        self.assertEqual(
+            self.grp_filter.passing_user_ids(User.objects.all()),
+            {1, 7}
+        )
+        self.assertEqual(
+            self.grp_filter_inverted.passing_user_ids(User.objects.all()),
+            {2, 3, 4, 5, 6, 8, 9, 10}
+        )
+        self.assertEqual(
+            self.grp_filter_single.passing_user_ids(User.objects.all()),
+            {7}
+        )
+
+    def test_expression_passing_ids(self):
+        corp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.corp_filter.pk, content_type__model="altcorpfilter"
+        )
+        alli_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.alli_filter.pk, content_type__model="altalliancefilter"
+        )
+        expression = gb_models.FilterExpression.objects.create(
+            name="Expression", description="Expression",
+            first_term=corp_sf, second_term=alli_sf,
+            operator=gb_models.FilterExpression.OperatorChoices.OR
+        )
+        users = User.objects.filter(pk__in=[1, 2, 6, 7])
+
+        self.assertEqual(expression.passing_user_ids(users), {1, 2, 6, 7})
+
+        expression.operator = gb_models.FilterExpression.OperatorChoices.AND
+        self.assertEqual(expression.passing_user_ids(users), set())
+
+        expression.negate_result = True
+        self.assertEqual(expression.passing_user_ids(users), {1, 2, 6, 7})
+
+        expression.operator = gb_models.FilterExpression.OperatorChoices.XOR
+        expression.negate_result = False
+        self.assertEqual(expression.passing_user_ids(users), {1, 2, 6, 7})
+
+    def test_expression_nested_passing_ids(self):
+        corp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.corp_filter.pk, content_type__model="altcorpfilter"
+        )
+        alli_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.alli_filter.pk, content_type__model="altalliancefilter"
+        )
+        grp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter.pk, content_type__model="useringroupfilter"
+        )
+        self.disconnect_signals()
+        User.objects.get(id=1).groups.add(self.test_group)
+        User.objects.get(id=7).groups.add(self.test_group)
+        self.connect_signals()
+
+        inner = gb_models.FilterExpression.objects.create(
+            name="Inner", description="Inner",
+            first_term=corp_sf, second_term=alli_sf,
+            operator=gb_models.FilterExpression.OperatorChoices.OR
+        )
+        inner_sf = gb_models.SmartFilter.objects.get(
+            object_id=inner.pk, content_type__model="filterexpression"
+        )
+        outer = gb_models.FilterExpression.objects.create(
+            name="Outer", description="Outer",
+            first_term=inner_sf, second_term=grp_sf,
+            operator=gb_models.FilterExpression.OperatorChoices.XOR
+        )
+
+        self.assertEqual(
+            outer.passing_user_ids(User.objects.all()),
+            {2, 3, 4, 5, 6, 8, 9, 10}
+        )
+
+        outer.negate_result = True
+        self.assertEqual(
+            outer.passing_user_ids(User.objects.all()),
+            {1, 7}
+        )
+
+    def test_expression_cycle(self):
+        corp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.corp_filter.pk, content_type__model="altcorpfilter"
+        )
+        expression = gb_models.FilterExpression.objects.create(
+            name="Loop", description="Loop",
+            first_term=corp_sf, second_term=corp_sf,
+            operator=gb_models.FilterExpression.OperatorChoices.AND
+        )
+        expression.second_term = gb_models.SmartFilter.objects.get(
+            object_id=expression.pk, content_type__model="filterexpression"
+        )
+        expression.save()
+
+        with self.assertRaises(gb_filters.FilterCycleError):
+            expression.user_q()
+        with self.assertRaises(ValidationError):
+            expression.clean()
+        self.assertEqual(expression.passing_user_ids(User.objects.all()), set())
+
+    def test_resolve_filter_objects(self):
+        corp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.corp_filter.pk, content_type__model="altcorpfilter"
+        )
+        expression = gb_models.FilterExpression.objects.create(
+            name="Both", description="Both",
+            first_term=corp_sf, second_term=corp_sf,
+            operator=gb_models.FilterExpression.OperatorChoices.AND
+        )
+        smart_filters = list(gb_models.SmartFilter.objects.filter(
+            pk__in=[corp_sf.pk, corp_sf.pk + 1000]
+        ) | gb_models.SmartFilter.objects.filter(
+            object_id=expression.pk, content_type__model="filterexpression"
+        ))
+        ContentType.objects.get_for_model(gb_models.FilterExpression)  # warm the cache
+        # one query per filter type, the expression's terms are already known
+        with self.assertNumQueries(2):
+            gb_models.SmartFilter.resolve_filter_objects(smart_filters)
+        with self.assertNumQueries(0):
+            for sf in smart_filters:
+                _filter = sf.filter_object
+                if isinstance(_filter, gb_models.FilterExpression):
+                    self.assertEqual(_filter.first_term.filter_object.alt_corp.pk, self.corp_filter.alt_corp_id)
+
+    def test_smart_group_plan(self):
+        plan = self.test_s_group.get_plan()
+        self.assertEqual([f.pk for f in plan.filters], [self.test_s_group.filters.get().pk])
+        with self.assertNumQueries(0):
+            self.assertIs(self.test_s_group.get_plan(), plan)
+            self.test_s_group.get_filters()[0].filter_object.get_exemptions()
+
+        # changing the filters gives a new plan
+        group_filter = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter.pk, content_type__model="useringroupfilter"
+        )
+        self.test_s_group.filters.add(group_filter)
+        new_plan = self.test_s_group.get_plan()
+        self.assertNotEqual(new_plan.version, plan.version)
+        self.assertEqual(len(new_plan.filters), 2)
+
+    def test_expression_depth(self):
+        last_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.corp_filter.pk, content_type__model="altcorpfilter"
+        )
+        for i in range(3):
+            expression = gb_models.FilterExpression.objects.create(
+                name=f"Level {i}", description=f"Level {i}",
+                first_term=last_sf, second_term=last_sf,
+                operator=gb_models.FilterExpression.OperatorChoices.AND
+            )
+            last_sf = gb_models.SmartFilter.objects.get(
+                object_id=expression.pk, content_type__model="filterexpression"
+            )
+
+        self.assertEqual(
+            expression.passing_user_ids(User.objects.all()),
+            {1, 2, 3, 4, 5}
+        )
+        with patch.object(gb_app_settings, "SG_EXPRESSION_MAX_DEPTH", 2):
+            with self.assertRaises(gb_filters.FilterDepthError):
+                expression.user_q()
+
+    def test_filter_dependencies(self):
+        alli_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.alli_filter.pk, content_type__model="altalliancefilter"
+        )
+        grp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter.pk, content_type__model="useringroupfilter"
+        )
+        expression = gb_models.FilterExpression.objects.create(
+            name="Deps", description="Deps",
+            first_term=alli_sf, second_term=grp_sf,
+            operator=gb_models.FilterExpression.OperatorChoices.OR
+        )
+        expression_sf = gb_models.SmartFilter.objects.get(
+            object_id=expression.pk, content_type__model="filterexpression"
+        )
+        expression_group = gb_models.SmartGroup.objects.create(
+            group=self.test_group_4
+        )
+        expression_group.filters.add(expression_sf)
+
+        affected = gb_models.FilterDependency.affected_smart_groups
+        self.assertEqual(list(affected(corporation_ids=[2])), [self.test_s_group])
+        self.assertEqual(list(affected(alliance_ids=[1])), [expression_group])
+        self.assertEqual(list(affected(group_ids=[self.test_group_2.pk])), [expression_group])
+        self.assertEqual(list(affected(corporation_ids=[98000001])), [])
+
+        # exemptions count too
+        _alli = EveAllianceInfo.objects.create(
+            alliance_id=99000001,
+            alliance_name="Exempt Alliance",
+            alliance_ticker="EXMT",
+            executor_corp_id=2,
+        )
+        self.corp_filter.exempt_alliances.add(_alli)
+        self.assertEqual(list(affected(alliance_ids=[99000001])), [self.test_s_group])
+
+        # a term we can't index makes the expression depend on everything
+        gb_models.SmartFilter.objects.filter(pk=alli_sf.pk).update(object_id=999)
+        gb_models.FilterDependency.rebuild()
+        self.assertEqual(
+            set(affected(corporation_ids=[98000001])), {expression_group}
+        )
+
+    def test_filter_dependencies_migration(self):
+        migration = import_module("securegroups.migrations.0031_build_filter_dependencies")
+        gb_models.FilterDependency.objects.all().delete()
+        gb_models.SmartFilter.objects.update(dependencies_indexed=False)
+
+        migration.build_dependencies(django_apps, None)
+        self.assertFalse(gb_models.SmartFilter.objects.filter(dependencies_indexed=False).exists())
+        affected = gb_models.FilterDependency.affected_smart_groups
+        self.assertEqual(list(affected(corporation_ids=[2])), [self.test_s_group])
+        self.assertEqual(list(affected(corporation_ids=[98000001])), [])
+
     def test_generic_smart_group_task(self):
         cache.clear()
         reset_time = timezone.now() - timedelta(days=5)
@@ -483,6 +798,550 @@ class TestGroupBotFilters(TestCase):
 
         self.assertEqual(gb_models.GracePeriodRecord.objects.all().count(), 0)
 
+    def test_auto_group_bulk_membership(self):
+        cache.clear()
+        group = Group.objects.create(name="Test_Auto_Group")
+        smart_group = gb_models.SmartGroup.objects.create(
+            group=group,
+            auto_group=True,
+            include_in_updates=True,
+        )
+        smart_group.filters.add(self.test_s_group.filters.get())
+        self.disconnect_signals()
+        User.objects.get(id=9).groups.add(group)  # fails the filter
+        self.connect_signals()
+        received = []
+
+        def receiver(sender, instance, action, pk_set, **kwargs):
+            if instance == group and action in ("post_add", "post_remove"):
+                received.append((action, set(pk_set)))
+
+        m2m_changed.connect(receiver, sender=User.groups.through)
+        try:
+            with patch.object(gb_models.SmartGroup, "check_user") as check_user:
+                gb_tasks.run_smart_group_update(smart_group.id)
+                self.assertEqual(check_user.call_count, 0)
+        finally:
+            m2m_changed.disconnect(receiver, sender=User.groups.through)
+
+        self.assertEqual(
+            set(group.user_set.values_list("pk", flat=True)), {1, 2, 3, 4, 5}
+        )
+        self.assertEqual(
+            received,
+            [("post_remove", {9}), ("post_add", {1, 2, 3, 4, 5})]
+        )
+
+    def test_sharded_auto_group_update(self):
+        cache.clear()
+        group = Group.objects.create(name="Test_Sharded_Group")
+        smart_group = gb_models.SmartGroup.objects.create(
+            group=group,
+            auto_group=True,
+            include_in_updates=True,
+        )
+        smart_group.filters.add(self.test_s_group.filters.get())
+        self.disconnect_signals()
+        User.objects.get(id=9).groups.add(group)  # fails the filter
+        self.connect_signals()
+
+        users = gb_tasks.get_smart_group_users(smart_group)
+        bounds = gb_tasks.get_shard_bounds(users, 3)
+        self.assertEqual(bounds, [(None, 3), (4, 6), (7, 9), (10, None)])
+
+        with patch.object(gb_app_settings, "SG_UPDATE_SHARD_SIZE", 3):
+            sig = gb_tasks.get_update_signature(smart_group)
+            # already queued, so a second request is merged into it
+            self.assertIsNone(gb_tasks.get_update_signature(smart_group))
+        self.assertEqual(len(sig.tasks), 4)
+        run_id = sig.body.kwargs["run_id"]
+        # queueing doesn't hold the group, the first shard to start does
+        self.assertFalse(gb_tasks.RunLease.is_held(smart_group.id))
+
+        verdicts = [
+            gb_tasks.run_smart_group_shard(smart_group.id, lo, hi, run_id=run_id)
+            for lo, hi in bounds
+        ]
+        self.assertTrue(gb_tasks.RunLease.is_held(smart_group.id))
+        self.assertIsNone(gb_tasks.run_smart_group_shard(smart_group.id, None, 3))
+        self.assertIsNone(gb_tasks.get_update_signature(smart_group))
+        message = gb_tasks.finish_smart_group_update(verdicts, smart_group.id, run_id=run_id)
+        self.assertFalse(gb_tasks.RunLease.is_held(smart_group.id))
+
+        self.assertEqual(
+            set(group.user_set.values_list("pk", flat=True)), {1, 2, 3, 4, 5}
+        )
+        self.assertIn("Checked 10 Members", message)
+        self.assertIn("Added 5, Removed 1", message)
+
+        run = smart_group.runs.get()
+        self.assertEqual(run.shards, 4)
+        self.assertEqual(run.mode, gb_models.SmartGroupRun.MODE_SHORT_CIRCUIT)
+        self.assertEqual((run.checked, run.added, run.removed), (10, 5, 1))
+        self.assertGreater(run.queries, 0)
+        self.assertGreater(run.loop_time, 0)
+        self.assertGreaterEqual(run.finished, run.started)
+
+    def test_pending_user_checks(self):
+        cache.clear()
+        group = Group.objects.create(name="Test_Pending_Group")
+        smart_group = gb_models.SmartGroup.objects.create(
+            group=group,
+            auto_group=True,
+            include_in_updates=True,
+        )
+        smart_group.filters.add(self.test_s_group.filters.get())
+        gb_models.PendingUserCheck.objects.all().delete()
+
+        User.objects.get(id=10).groups.add(self.test_group_3)
+        self.assertFalse(gb_models.PendingUserCheck.objects.exists())  # nothing cares
+
+        self.test_s_group.filters.add(
+            gb_models.SmartFilter.objects.get(
+                object_id=self.grp_filter_single.pk, content_type__model="useringroupfilter"
+            )
+        )
+        User.objects.get(id=10).groups.add(self.test_group_2)
+        # only the group filtering on it is re-checked
+        self.assertEqual(
+            set(gb_models.PendingUserCheck.objects.values_list("user_id", "smart_group_id")),
+            {(10, self.test_s_group.pk)}
+        )
+        character = EveCharacter.objects.get(character_id=12)
+        character.corporation_id = 3
+        character.save()
+        owner = CharacterOwnership.objects.get(character=character).user_id
+        gb_models.PendingUserCheck.queue([10, 9])
+        self.assertEqual(
+            set(gb_models.PendingUserCheck.objects.values_list("user_id", flat=True)),
+            {10, 9, owner}
+        )
+        self.assertEqual(
+            set(gb_models.PendingUserCheck.objects.filter(user_id=9).values_list("smart_group_id", flat=True)),
+            {self.test_s_group.pk, smart_group.pk}
+        )
+
+        gb_models.PendingUserCheck.objects.all().delete()
+        gb_models.PendingUserCheck.queue([1, 9], [smart_group.pk])
+        # an update holds the group, the users wait for the next run
+        lease = gb_tasks.RunLease(smart_group.pk)
+        self.assertTrue(lease.claim())
+        gb_tasks.run_pending_user_checks()
+        self.assertFalse(group.user_set.exists())
+        self.assertEqual(
+            set(gb_models.PendingUserCheck.objects.values_list("user_id", flat=True)), {1, 9}
+        )
+        lease.release()
+
+        gb_tasks.run_pending_user_checks()
+
+        self.assertEqual(set(group.user_set.values_list("pk", flat=True)), {1})
+        self.assertFalse(gb_models.PendingUserCheck.objects.exists())
+
+    def test_failed_update_releases_leases(self):
+        cache.clear()
+        queued = []
+        sig = gb_tasks.get_update_signature(self.test_s_group, queued=queued)
+        self.assertIsNotNone(sig)
+        self.assertEqual(queued, [(self.test_s_group.pk, sig.kwargs["run_id"])])
+        self.assertIsNone(gb_tasks.get_update_signature(self.test_s_group))
+
+        # the update never ran, the errback frees the group for the next one
+        gb_tasks.release_run_leases(queued)
+        self.assertIsNotNone(gb_tasks.get_update_signature(self.test_s_group))
+
+    def test_process_user_by_id(self):
+        smart_filter = self.test_s_group.filters.get()
+        check = gb_tasks.process_user(smart_filter, 1, {smart_filter.id: {1}}, {})
+        self.assertTrue(check["check"])
+
+        # no bulk result, falls back to loading the user
+        check = gb_tasks.process_user(smart_filter, 1, {}, {})
+        self.assertTrue(check["check"])
+        check = gb_tasks.process_user(smart_filter, 9, {}, {})
+        self.assertFalse(check["check"])
+
+    def test_failure_state_bulk(self):
+        cache.clear()
+        gb_tasks.set_failure(self.test_s_group.id, 1)
+        gb_tasks.set_failures(self.test_s_group.id, {2, 3})
+        self.assertEqual(
+            gb_tasks.get_failures(self.test_s_group.id, {1, 2, 3, 4}, chunk_size=2),
+            {1, 2, 3}
+        )
+        gb_tasks.clear_failures(self.test_s_group.id, {1, 3})
+        self.assertEqual(gb_tasks.get_failures(self.test_s_group.id, {1, 2, 3, 4}), {2})
+        self.assertTrue(gb_tasks.get_failure(self.test_s_group.id, 2))
+
+    def test_update_removes_users_without_main(self):
+        cache.clear()
+        self.disconnect_signals()
+        self.test_group.user_set.add(*User.objects.filter(id__in=[1, 2]))
+        self.connect_signals()
+        profile = User.objects.get(id=2).profile
+        profile.main_character = None
+        profile.save()
+
+        verdict = gb_tasks.evaluate_smart_group(self.test_s_group, User.objects.filter(id__in=[1, 2]))
+        self.assertEqual(verdict["to_remove"], [2])
+        self.assertEqual(verdict["removed"], 1)
+        self.assertEqual(verdict["checked"], 1)
+
+    def test_recheck_leaves_failures(self):
+        cache.clear()
+        self.disconnect_signals()
+        self.test_group.user_set.add(*User.objects.filter(id__in=[7, 9]))
+        self.connect_signals()
+        gb_tasks.set_failure(self.test_s_group.id, 7)  # first strike from a full update
+
+        verdict = gb_tasks.recheck_users(self.test_s_group, {7, 9})
+        self.assertEqual(verdict["pending_removals"], 2)
+        self.assertFalse(gb_models.GracePeriodRecord.objects.exists())
+        self.assertEqual(gb_tasks.get_failures(self.test_s_group.id, {7, 9}), {7})
+
+    def test_save_grace_changes(self):
+        smart_filter = self.test_s_group.filters.get()
+        expires = timezone.now() + timedelta(days=5)
+
+        def graces():
+            return [
+                gb_models.GracePeriodRecord(
+                    user_id=uid,
+                    group=self.test_s_group,
+                    grace_filter=smart_filter,
+                    expires=expires
+                ) for uid in (7, 9, 10)
+            ]
+
+        gb_tasks.save_grace_changes(self.test_s_group, graces(), [], [], [])
+        gb_tasks.save_grace_changes(self.test_s_group, graces(), [], [], [])
+        self.assertEqual(gb_models.GracePeriodRecord.objects.count(), 3)
+
+        expired = gb_models.GracePeriodRecord.objects.get(user_id=7).pk
+        gb_tasks.save_grace_changes(self.test_s_group, [], [expired], [9], [])
+        self.assertEqual(
+            list(gb_models.GracePeriodRecord.objects.values_list("user_id", flat=True)),
+            [10]
+        )
+
+    def test_parallel_updates(self):
+        for i in range(3):
+            gb_models.SmartGroup.objects.create(
+                group=Group.objects.create(name=f"Test_Lane_Group_{i}")
+            )
+        with patch.object(gb_app_settings, "SG_PARALLEL_UPDATES", True), \
+                patch.object(gb_app_settings, "SG_PARALLEL_UPDATE_LANES", 3), \
+                patch.object(gb_tasks, "chord") as chord:
+            gb_tasks.run_smart_groups()
+
+        header, body = chord.call_args[0]
+        self.assertEqual(len(header.tasks), 3)
+        self.assertEqual(
+            sorted(len(lane.tasks) for lane in header.tasks), [1, 1, 2]
+        )
+        self.assertEqual(
+            [t.task for t in body.tasks],
+            [
+                "securegroups.tasks.notify_users",
+                "securegroups.tasks.flush_webhook_messages",
+                "securegroups.tasks.clear_cycle_results",
+            ]
+        )
+        self.assertEqual(
+            [c[0][0].task for c in chord.return_value.on_error.call_args_list],
+            [
+                "securegroups.tasks.flush_webhook_messages",
+                "securegroups.tasks.clear_cycle_results",
+                "securegroups.tasks.release_run_leases",
+            ]
+        )
+        # every group queued is freed if the cycle fails
+        self.assertEqual(len(chord.return_value.on_error.call_args[0][0].args[0]), 4)
+
+    def test_process_expired_graces(self):
+        cache.clear()
+        self.disconnect_signals()
+        for uid in (1, 10, 9, 7):
+            User.objects.get(id=uid).groups.add(self.test_group)
+        self.connect_signals()
+
+        gb_tasks.run_smart_group_update(self.test_s_group.id)
+        gb_tasks.run_smart_group_update(self.test_s_group.id)
+        self.assertEqual(gb_models.GracePeriodRecord.objects.count(), 3)
+
+        gb_tasks.process_expired_graces()  # nothing expired yet
+        self.assertEqual(gb_models.GracePeriodRecord.objects.count(), 3)
+
+        gb_models.GracePeriodRecord.objects.filter(user_id__in=[9, 10]).update(
+            expires=timezone.now() - timedelta(days=1)
+        )
+        gb_tasks.process_expired_graces()
+
+        self.assertEqual(
+            set(self.test_group.user_set.values_list("pk", flat=True)), {1, 7}
+        )
+        self.assertEqual(
+            list(gb_models.GracePeriodRecord.objects.values_list("user_id", flat=True)),
+            [7]
+        )
+
+    def test_webhook_messages_coalesced(self):
+        cache.clear()
+        gb_models.GroupUpdateWebhook.objects.create(
+            group=self.test_group, enabled=True, webhook="https://example.com/hook"
+        )
+        with patch.object(gb_tasks, "get_webhook_session") as session:
+            session.return_value.post.return_value.status_code = 204
+            gb_tasks.send_update_to_webhook(self.test_group, "first", cycle_id="test")
+            gb_tasks.send_update_to_webhook(self.test_group, "second", cycle_id="test")
+            self.assertEqual(session.return_value.post.call_count, 0)
+
+            gb_tasks.flush_webhook_messages("test")
+            self.assertEqual(session.return_value.post.call_count, 1)
+            self.assertEqual(
+                session.return_value.post.call_args[1]["data"],
+                '{"content": "first\\n\\nsecond\\n"}'
+            )
+            self.assertEqual(
+                session.return_value.post.call_args[1]["timeout"], gb_tasks.WEBHOOK_TIMEOUT
+            )
+
+    def test_discord_messages_retried(self):
+        cache.clear()
+        with patch.object(gb_app_settings, "discord_bot_active", return_value=True), \
+                patch.object(gb_tasks, "get_discord_user_ids", return_value={1: 101, 2: 102}), \
+                patch.object(gb_tasks, "deliver_discord_dm", side_effect=[None, Exception("down")]) as deliver, \
+                patch.object(gb_tasks.send_discord_messages, "apply_async") as later, \
+                patch.object(gb_tasks.send_discord_messages, "delay"):
+            dms = []
+            gb_tasks.send_discord_dm(1, "Title", "one", 255, pending=dms)
+            gb_tasks.send_discord_dm(2, "Title", "two", None, pending=dms)
+            gb_tasks.send_discord_dm(3, "Title", "three", None, pending=dms)
+            gb_tasks.queue_discord_messages(dms)
+
+            gb_tasks.send_discord_messages()
+            self.assertEqual(deliver.call_count, 2)
+            self.assertEqual(deliver.call_args_list[0][0][1], 101)
+            # undeliverable is gone, the rest wait for the bot or a retry
+            sent, failed = gb_models.PendingDiscordMessage.objects.order_by("user_id")
+            self.assertEqual((sent.user_id, failed.user_id), (1, 2))
+            self.assertEqual(failed.attempts, 1)
+            self.assertGreater(failed.next_attempt, timezone.now())
+            self.assertTrue(later.called)
+
+            # only confirmed messages leave the outbox
+            gb_tasks.discord_message_sent(sent.pk)
+            self.assertEqual(gb_models.PendingDiscordMessage.objects.get(), failed)
+
+            failed.attempts = gb_tasks.DM_MAX_ATTEMPTS
+            failed.save()
+            gb_tasks.discord_message_failed(failed.pk)
+            self.assertFalse(gb_models.PendingDiscordMessage.objects.exists())
+
+    def test_discord_messages_rate_limited(self):
+        cache.clear()
+        with patch.object(gb_app_settings, "discord_bot_active", return_value=True), \
+                patch.object(gb_app_settings, "SG_DISCORD_DM_BURST", 1), \
+                patch.object(gb_tasks, "get_discord_user_ids", return_value={1: 101, 2: 102}), \
+                patch.object(gb_tasks, "deliver_discord_dm") as deliver, \
+                patch.object(gb_tasks.send_discord_messages, "apply_async") as later, \
+                patch.object(gb_tasks.send_discord_messages, "delay"):
+            dms = []
+            gb_tasks.send_discord_dm(1, "Title", "one", None, pending=dms)
+            gb_tasks.send_discord_dm(2, "Title", "two", None, pending=dms)
+            gb_tasks.queue_discord_messages(dms)
+
+            gb_tasks.send_discord_messages()
+            # one token, the second message is sent later rather than waited for
+            self.assertEqual(deliver.call_count, 1)
+            self.assertGreater(later.call_args[1]["countdown"], 0)
+            self.assertEqual(
+                gb_models.PendingDiscordMessage.objects.get(user_id=2).attempts, 0
+            )
+
+    def test_grace_notify_user_queued(self):
+        grace = gb_models.GracePeriodRecord.objects.create(
+            group=self.test_s_group,
+            user_id=1,
+            grace_filter=self.test_s_group.filters.get(),
+            expires=timezone.now(),
+        )
+        with patch.object(gb_app_settings, "discord_bot_active", return_value=True), \
+                patch.object(gb_tasks.send_discord_messages, "delay") as send:
+            with self.captureOnCommitCallbacks(execute=True):
+                grace.notify_user("Fix it")
+                self.assertFalse(gb_models.PendingDiscordMessage.objects.exists())
+            self.assertTrue(send.called)
+        self.assertEqual(gb_models.PendingDiscordMessage.objects.get().message, "Fix it")
+
+    def test_token_bucket(self):
+        cache.clear()
+        bucket = gb_tasks.TokenBucket("test-bucket", rate=1, burst=2)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        bucket.save()
+        # a new run carries on from what's left
+        bucket = gb_tasks.TokenBucket("test-bucket", rate=1, burst=2)
+        with patch.object(gb_tasks.time, "time", return_value=bucket.updated):
+            self.assertAlmostEqual(bucket.take(), 1, places=2)
+        with patch.object(gb_tasks.time, "time", return_value=bucket.updated + 1):
+            self.assertEqual(bucket.take(), 0)
+
+    def test_split_webhook_messages(self):
+        self.assertEqual(
+            gb_tasks.split_webhook_messages(["a" * 6, "b" * 3, "c" * 12], max_length=10),
+            ["aaaaaa\nbbb", "cccccccccc", "cc"]
+        )
+
+    def test_webhook_retry_after(self):
+        with patch.object(gb_tasks, "get_webhook_session") as session, \
+                patch.object(gb_tasks.send_webhook_messages, "retry", side_effect=Exception) as retry:
+            session.return_value.post.return_value.status_code = 429
+            session.return_value.post.return_value.headers = {"Retry-After": "3"}
+            with self.assertRaises(Exception):
+                gb_tasks.send_webhook_messages("https://example.com/hook", ["one", "two"])
+            self.assertEqual(retry.call_args[1]["countdown"], 3.0)
+            self.assertEqual(
+                retry.call_args[1]["args"], ["https://example.com/hook", ["one\ntwo"]]
+            )
+
+    def test_cycle_results_shared(self):
+        cache.clear()
+        users = User.objects.all()
+        with patch.object(
+            gb_models.AltCorpFilter, "passing_user_ids", return_value={1, 2}
+        ) as passing:
+            first = gb_tasks.process_users_in_bulk(
+                self.test_s_group, users, cycle_id="test"
+            )
+            second = gb_tasks.process_users_in_bulk(
+                self.test_s_group, users, cycle_id="test"
+            )
+            self.assertEqual(passing.call_count, 1)
+
+            gb_tasks.process_users_in_bulk(
+                self.test_s_group, users.filter(pk__in=[1, 2, 3]), cycle_id="test"
+            )
+            self.assertEqual(passing.call_count, 2)
+            # both populations are kept side by side
+            gb_tasks.process_users_in_bulk(
+                self.test_s_group, users, cycle_id="test"
+            )
+            self.assertEqual(passing.call_count, 2)
+
+            gb_tasks.clear_cycle_results("test")
+            gb_tasks.process_users_in_bulk(
+                self.test_s_group, users, cycle_id="test"
+            )
+            self.assertEqual(passing.call_count, 3)
+
+        self.assertEqual(first, second)
+
+    def test_cycle_results_not_shared_for_groups(self):
+        cache.clear()
+        grp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter.pk, content_type__model="useringroupfilter"
+        )
+        self.test_s_group.filters.add(grp_sf)
+        users = User.objects.all()
+        with patch.object(
+            gb_models.UserInGroupFilter, "passing_user_ids", return_value={1}
+        ) as passing:
+            gb_tasks.process_users_in_bulk(
+                self.test_s_group, users, cycle_id="test"
+            )
+            gb_tasks.process_users_in_bulk(
+                self.test_s_group, users, cycle_id="test"
+            )
+            self.assertEqual(passing.call_count, 2)
+
+    def test_filter_stats(self):
+        cache.clear()
+        smart_filter = self.test_s_group.filters.get()
+        gb_tasks.process_users_in_bulk(self.test_s_group, User.objects.all())
+        stats = gb_models.SmartFilterStats.objects.get(smart_filter=smart_filter)
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(stats.avg_users, User.objects.count())
+        self.assertEqual(stats.fail_rate, (User.objects.count() - 5) / User.objects.count())
+        self.assertGreater(stats.avg_queries, 0)
+        self.assertEqual(stats.fallback_rate, 0)
+
+        # bulk check falls back to one user at a time
+        with patch.object(
+            gb_models.AltCorpFilter, "passing_user_ids",
+            lambda f, users: gb_filters.audit_passing_user_ids(f, users)
+        ), patch.object(gb_models.AltCorpFilter, "audit_filter", side_effect=Exception):
+            gb_tasks.process_users_in_bulk(self.test_s_group, User.objects.all())
+        stats.refresh_from_db()
+        self.assertEqual(stats.calls, 2)
+        self.assertAlmostEqual(stats.fallback_rate, STATS_SMOOTHING)
+
+    def test_planner_order(self):
+        cache.clear()
+        corp_sf = self.test_s_group.filters.get()
+        grp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter.pk, content_type__model="useringroupfilter"
+        )
+        gb_models.SmartFilterStats.objects.create(
+            smart_filter=corp_sf, calls=1, avg_time=1, avg_users=10, fail_rate=0.1
+        )
+        gb_models.SmartFilterStats.objects.create(
+            smart_filter=grp_sf, calls=1, avg_time=1, avg_users=10, fail_rate=0.9
+        )
+
+        self.assertEqual(FilterPlanner([corp_sf, grp_sf]).ordered(), [grp_sf, corp_sf])
+
+    def test_short_circuit_bulk(self):
+        cache.clear()
+        self.disconnect_signals()
+        User.objects.get(id=1).groups.add(self.test_group)
+        User.objects.get(id=7).groups.add(self.test_group)
+        self.connect_signals()
+        grp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter.pk, content_type__model="useringroupfilter"
+        )
+        self.test_s_group.filters.add(grp_sf)
+        gb_models.SmartFilterStats.objects.create(
+            smart_filter=grp_sf, calls=1, avg_users=10, fail_rate=0.9
+        )
+
+        users = User.objects.all()
+        full = gb_tasks.process_users_in_bulk(self.test_s_group, users)
+        self.assertEqual(full[grp_sf.id], {1, 7})
+        self.assertEqual(full[self.test_s_group.filters.get(pk__lt=grp_sf.pk).id], {1, 2, 3, 4, 5})
+
+        with patch.object(
+            gb_models.AltCorpFilter,
+            "passing_user_ids",
+            side_effect=lambda qs: set(qs.values_list("pk", flat=True)) & {1, 2, 3, 4, 5}
+        ) as passing:
+            short = gb_tasks.process_users_in_bulk(
+                self.test_s_group, users, short_circuit=True
+            )
+            # only the users that passed the group filter get checked
+            self.assertEqual(
+                set(passing.call_args[0][0].values_list("pk", flat=True)), {1, 7}
+            )
+        self.assertEqual(set.intersection(*short.values()), {1})
+
+    def test_check_user_stops_on_first_fail(self):
+        cache.clear()
+        grp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter.pk, content_type__model="useringroupfilter"
+        )
+        self.test_s_group.filters.add(grp_sf)
+        gb_models.SmartFilterStats.objects.create(
+            smart_filter=grp_sf, calls=1, avg_time=1, avg_users=1, fail_rate=0
+        )
+
+        with patch.object(
+            gb_models.UserInGroupFilter, "passing_user_ids", return_value=set()
+        ) as passing:
+            self.assertFalse(self.test_s_group.check_user(User.objects.get(id=10)))
+            self.assertEqual(passing.call_count, 0)
+        # the join checks don't feed the bulk stats
+        self.assertEqual(gb_models.SmartFilterStats.objects.count(), 1)
+
     def test_fail_view(self):
         user = User.objects.get(id=7)
         permission = AuthUtils.get_permission_by_name(
@@ -517,6 +1376,174 @@ class TestGroupBotFilters(TestCase):
         self.assertContains(response, "Join Group")
         self.assertNotContains(response, "Running Group Check Failed")
 
+    def test_audit_list_run_history(self):
+        user = User.objects.get(id=1)
+        user.user_permissions.add(
+            AuthUtils.get_permission_by_name("securegroups.audit_sec_group"),
+            AuthUtils.get_permission_by_name("auth.group_management"),
+        )
+        now = timezone.now()
+        for duration in (2, 4):
+            gb_models.SmartGroupRun.objects.create(
+                group=self.test_s_group,
+                started=now - timedelta(seconds=duration),
+                finished=now,
+                duration=duration,
+            )
+        self.client.force_login(user)
+        with self.settings(STORAGES={
+            "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+            "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        }):
+            response = self.client.get(reverse("securegroups:audit_list"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Average 3.0s")
+
+    def test_groups_view_cached(self):
+        cache.clear()
+        user = User.objects.get(id=1)
+        user.user_permissions.add(
+            AuthUtils.get_permission_by_name("securegroups.access_sec_group")
+        )
+        groups = gb_views.get_groups_view_groups(user)
+        self.assertEqual([g["smart_group"] for g in groups], [self.test_s_group])
+        self.assertIsNone(groups[0]["request"])
+        with self.assertNumQueries(0):
+            gb_views.get_groups_view_groups(user)
+
+        GroupRequest.objects.create(user=user, group=self.test_group)
+        groups = gb_views.get_groups_view_groups(user)
+        self.assertEqual(groups[0]["request"].group, self.test_group)
+
+        self.client.force_login(user)
+        with self.settings(STORAGES={
+            "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+            "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        }):
+            response = self.client.get(reverse("securegroups:groups"))
+        self.assertContains(response, "Pending Join Requet")
+
+        self.disconnect_signals()
+        user.groups.add(self.test_group)
+        self.connect_signals()
+        gb_models.GracePeriodRecord.objects.create(
+            group=self.test_s_group,
+            user=user,
+            grace_filter=self.test_s_group.filters.get(),
+            expires=timezone.now(),
+        )
+        self.assertIsNotNone(gb_views.get_groups_view_groups(user)[0]["grace_msg"])
+        # deleted from the admin
+        gb_admin.GraceAdmin(gb_models.GracePeriodRecord, admin_site).delete_queryset(
+            None, gb_models.GracePeriodRecord.objects.filter(user=user)
+        )
+        self.assertIsNone(gb_views.get_groups_view_groups(user)[0]["grace_msg"])
+
+        # cleaned up by an update once they have left the group
+        gb_models.GracePeriodRecord.objects.create(
+            group=self.test_s_group,
+            user=user,
+            grace_filter=self.test_s_group.filters.get(),
+            expires=timezone.now(),
+        )
+        self.assertIsNotNone(gb_views.get_groups_view_groups(user)[0]["grace_msg"])
+        self.disconnect_signals()
+        user.groups.remove(self.test_group)
+        self.connect_signals()
+        gb_tasks.apply_smart_group_update(
+            self.test_s_group, [gb_tasks.evaluate_smart_group(self.test_s_group, User.objects.none())],
+            report=False
+        )
+        self.assertFalse(gb_models.GracePeriodRecord.objects.filter(user=user).exists())
+        self.assertIsNone(gb_views.get_groups_view_groups(user)[0]["grace_msg"])
+
+    def test_audit_matrix(self):
+        user = User.objects.get(id=1)
+        user.user_permissions.add(
+            AuthUtils.get_permission_by_name("securegroups.audit_sec_group"),
+            AuthUtils.get_permission_by_name("auth.group_management"),
+        )
+        self.disconnect_signals()
+        self.test_group.user_set.add(*User.objects.filter(id__in=[1, 2, 3, 7, 9]))
+        self.connect_signals()
+        smart_filter = self.test_s_group.filters.get()
+        self.client.force_login(user)
+
+        url = reverse("securegroups:audit_matrix", args=[self.test_s_group.id])
+        response = self.client.post(url, {"page": 2, "page_size": 2, "filters": str(smart_filter.id)})
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual((data["page"], data["pages"]), (2, 3))
+        self.assertEqual(
+            [(c["uid"], c["fid"], c["result"]) for c in data["results"]],
+            [(3, smart_filter.id, True), (7, smart_filter.id, False)]
+        )
+
+        response = self.client.post(url, {"filters": "0"})
+        self.assertEqual(json.loads(b"".join(response.streaming_content))["results"], [])
+        self.assertEqual(self.client.post(url, {"filters": "x"}).status_code, 400)
+
+    def test_audit_snapshot(self):
+        user = User.objects.get(id=1)
+        user.user_permissions.add(
+            AuthUtils.get_permission_by_name("securegroups.audit_sec_group"),
+            AuthUtils.get_permission_by_name("auth.group_management"),
+        )
+        self.disconnect_signals()
+        self.test_group.user_set.add(*User.objects.filter(id__in=[1, 2, 7]))
+        self.connect_signals()
+        smart_filter = self.test_s_group.filters.get()
+        gb_tasks.run_smart_group_update(self.test_s_group.id, fake_run=True)
+        snapshot = gb_models.AuditSnapshot.objects.get(group=self.test_s_group)
+        self.assertEqual(snapshot.filters, [smart_filter.id])
+        self.assertEqual({uid: row[0][0] for uid, row in snapshot.results.items()},
+                         {"1": True, "2": True, "7": False})
+
+        self.client.force_login(user)
+        url = reverse("securegroups:audit_matrix", args=[self.test_s_group.id])
+        with patch.object(gb_models.AltCorpFilter, "passing_user_ids") as passing:
+            response = self.client.post(url)
+            data = json.loads(b"".join(response.streaming_content))
+            passing.assert_not_called()
+        self.assertEqual(data["snapshot"], snapshot.created.isoformat())
+        self.assertEqual(
+            [(c["uid"], c["result"]) for c in data["results"]],
+            [(1, True), (2, True), (7, False)]
+        )
+
+        response = self.client.post(url, {"live": 1})
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertIsNone(data["snapshot"])
+        self.assertEqual(len(data["results"]), 3)
+
+    def test_audit_snapshot_short_circuit(self):
+        cache.clear()
+        gb_models.SmartGroup.objects.filter(pk=self.test_s_group.pk).update(can_grace=False)
+        self.disconnect_signals()
+        self.test_group.user_set.add(*User.objects.filter(id__in=[1, 2, 7]))
+        self.connect_signals()
+        corp_sf = self.test_s_group.filters.get()
+        grp_sf = gb_models.SmartFilter.objects.get(
+            object_id=self.grp_filter_single.pk, content_type__model="useringroupfilter"
+        )
+        self.test_s_group.filters.add(grp_sf)
+        # nobody is in the group, so it runs first and fails everyone
+        gb_models.SmartFilterStats.objects.create(
+            smart_filter=grp_sf, calls=1, avg_time=1, avg_users=1, fail_rate=1
+        )
+        gb_models.SmartFilterStats.objects.create(
+            smart_filter=corp_sf, calls=1, avg_time=1, avg_users=1, fail_rate=0
+        )
+
+        with patch.object(gb_models.AltCorpFilter, "audit_filter") as audit:
+            gb_tasks.run_smart_group_update(self.test_s_group.id, fake_run=True)
+            # no messages for a filter that never ran
+            audit.assert_not_called()
+        snapshot = gb_models.AuditSnapshot.objects.get(group=self.test_s_group)
+        corp, grp = snapshot.filters.index(corp_sf.id), snapshot.filters.index(grp_sf.id)
+        for row in snapshot.results.values():
+            self.assertFalse(row[grp][0])
+            self.assertIsNone(row[corp][0])
+
     def test_no_perm_view(self):
         user = User.objects.get(id=5)
         self.assertFalse(user.has_perm("securegroups.access_sec_group"))
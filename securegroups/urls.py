@@ -11,6 +11,8 @@ urlpatterns = [
             views.groups_manager_view, name='audit'),
     re_path(r'^audit/(?P<sg_id>(\d)*)/(?P<filter_id>(\d)*)/$',
             views.groups_manager_checks, name='audit_check'),
+    re_path(r'^audit/(?P<sg_id>(\d)*)/matrix/$',
+            views.groups_manager_matrix, name='audit_matrix'),
 
     path('group/', include([
         re_path(r'^request_check/(?P<group_id>(\d)*)/$', views.smart_group_run_check,
@@ -1,5 +1,7 @@
+import json
 import logging
 from collections import defaultdict
+from itertools import chain
 
 from django.conf import settings
 from django.contrib import messages
@@ -7,9 +9,14 @@ from django.contrib.auth.decorators import (
     permission_required, user_passes_test,
 )
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
-from django.db.models import Count, Q
-from django.http import Http404, HttpResponse, JsonResponse
+from django.core.paginator import Paginator
+from django.db.models import Avg, Count, OuterRef, Q, Subquery
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.utils.translation import gettext_lazy as _
@@ -17,18 +24,33 @@ from django.utils.translation import gettext_lazy as _
 from allianceauth.groupmanagement.managers import GroupManager
 from allianceauth.groupmanagement.models import GroupRequest, RequestLog
 
-from .models import GracePeriodRecord, SmartFilter, SmartGroup
-from .tasks import run_smart_group_update
+from .models import (
+    AuditSnapshot, GracePeriodRecord, SmartFilter, SmartGroup, SmartGroupRun,
+)
+from .tasks import (
+    GROUPS_VIEW_TIMEOUT, audit_matrix, get_groups_view_key,
+    get_update_signature, release_run_leases,
+)
 
 logger = logging.getLogger(__name__)
 
+# members per page of the audit matrix
+AUDIT_PAGE_SIZE = 1000
 
-@permission_required("securegroups.access_sec_group")
-def groups_view(request):
-    logger.debug("groups_view called by user %s" % request.user)
-    usr_groups = request.user.groups.all()
+
+def get_groups_view_groups(user):
+    """
+    The Smart Groups a user can see on the groups page, with their request, grace and
+    membership state, in a fixed number of queries. Cached until one of those changes.
+    """
+    key = get_groups_view_key(user.pk)
+    groups = cache.get(key)
+    if groups is not None:
+        return groups
+
+    usr_group_ids = set(user.groups.values_list("pk", flat=True))
     groups_qs = Group.objects.filter(
-        Q(authgroup__states=request.user.profile.state) | Q(authgroup__states=None)
+        Q(authgroup__states=user.profile.state) | Q(authgroup__states=None)
     )
 
     smart_groups_qs = SmartGroup.objects.filter(
@@ -41,28 +63,39 @@ def groups_view(request):
         'group__authgroup__group_leaders',
         'group__authgroup__group_leaders__profile__main_character',
         'group__authgroup__group_leader_groups')
-    graces_qs = GracePeriodRecord.objects.filter(user=request.user)
-    graces = {}
+    graces_qs = GracePeriodRecord.objects.filter(
+        user=user
+    ).select_related("grace_filter")
+    SmartFilter.resolve_filter_objects(g.grace_filter for g in graces_qs)
+    graces = defaultdict(list)
     for g in graces_qs:
-        if g.group.group.name not in graces:
-            graces[g.group.group.name] = []
-        graces[g.group.group.name].append(
-            g.grace_filter.filter_object.description)
+        graces[g.group_id].append(g.grace_filter.filter_object.description)
+    group_requests = {}
+    for r in GroupRequest.objects.filter(user=user):
+        group_requests.setdefault(r.group_id, r)
+
     groups = []
     for smart_group in smart_groups_qs:
-        group_request = GroupRequest.objects.filter(user=request.user).filter(
-            group=smart_group.group
-        )
+        is_member = smart_group.group_id in usr_group_ids
         grace_msg = None
-        if smart_group.group.name in graces and smart_group.group in usr_groups:
-            grace_msg = "<br>".join(graces[smart_group.group.name])
+        if smart_group.pk in graces and is_member:
+            grace_msg = "<br>".join(graces[smart_group.pk])
         groups.append(
             {
                 "smart_group": smart_group,
-                "request": group_request[0] if group_request else None,
-                "grace_msg": grace_msg
+                "request": group_requests.get(smart_group.group_id),
+                "grace_msg": grace_msg,
+                "is_member": is_member,
             }
         )
+    cache.set(key, groups, GROUPS_VIEW_TIMEOUT)
+    return groups
+
+
+@permission_required("securegroups.access_sec_group")
+def groups_view(request):
+    logger.debug("groups_view called by user %s" % request.user)
+    groups = get_groups_view_groups(request.user)
 
     count = 0
     perms = GroupManager.can_manage_groups(request.user)
@@ -83,6 +116,11 @@ def groups_manager_checks(request, sg_id=None, filter_id=None):
         fltr = SmartFilter.objects.get(id=filter_id)
         users = sg.group.user_set.all()
         out = []
+        snapshot = get_audit_snapshot(request, sg)
+        if snapshot:
+            # only the members that joined since the last update need checking
+            out = snapshot.cells([fltr], users.values_list("pk", flat=True))
+            users = users.exclude(pk__in=[c["uid"] for c in out])
         try:
             _o = fltr.filter_object.audit_filter(users)
         except Exception as e:
@@ -106,6 +144,72 @@ def groups_manager_checks(request, sg_id=None, filter_id=None):
     raise Http404("Does not exist")
 
 
+def get_audit_snapshot(request, smart_group):
+    """
+    The group's `AuditSnapshot` from its last update, unless `live` results were asked for.
+    """
+    if request.POST.get("live"):
+        return None
+    return AuditSnapshot.objects.filter(group=smart_group).first()
+
+
+def stream_audit_matrix(smart_group, filters, page, snapshot=None):
+    user_ids = list(page.object_list)
+    created = snapshot.created.isoformat() if snapshot else None
+    yield (
+        f'{{"page": {page.number}, "pages": {page.paginator.num_pages}, '
+        f'"snapshot": {json.dumps(created)}, "results": ['
+    )
+    batches = []
+    if snapshot:
+        # serve what the last update saw, and only run what it doesn't know about
+        known = [uid for uid in user_ids if str(uid) in snapshot.results]
+        user_ids = [uid for uid in user_ids if str(uid) not in snapshot.results]
+        new_filters = [f for f in filters if f.id not in snapshot.filters]
+        batches.append([snapshot.cells(filters, known)])
+        if known and new_filters:
+            batches.append(audit_matrix(smart_group, new_filters, known))
+    if user_ids:
+        batches.append(audit_matrix(smart_group, filters, user_ids))
+    first = True
+    for cells in chain.from_iterable(batches):
+        if cells:
+            yield ("" if first else ", ") + ", ".join(json.dumps(c) for c in cells)
+            first = False
+    yield "]}"
+
+
+@permission_required("securegroups.audit_sec_group")
+@user_passes_test(GroupManager.can_manage_groups)
+def groups_manager_matrix(request, sg_id=None):
+    """
+    Every member against every filter of a Smart Group in one pass, streamed as
+    `{"page", "pages", "snapshot", "results": [{"uid", "fid", "result", "message"}, ...]}`.
+    POST `page`, `page_size` and a comma separated list of `filters` to limit it to.
+    Results come from the last update's `AuditSnapshot`, `snapshot` is when it was taken,
+    POST `live` to run every filter now instead.
+    """
+    logger.debug("groups_manager_matrix called by user %s" % request.user)
+    if request.method != "POST":
+        raise Http404("Does not exist")
+    sg = get_object_or_404(SmartGroup, id=sg_id)
+
+    filters = sg.get_filters()
+    try:
+        if request.POST.get("filters"):
+            selected = {int(f_id) for f_id in request.POST["filters"].split(",")}
+            filters = [f for f in filters if f.id in selected]
+        page_size = min(int(request.POST.get("page_size", AUDIT_PAGE_SIZE)), AUDIT_PAGE_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid filters or page size")
+
+    members = sg.group.user_set.order_by("pk").values_list("pk", flat=True)
+    page = Paginator(members, max(page_size, 1)).get_page(request.POST.get("page"))
+    return StreamingHttpResponse(
+        stream_audit_matrix(sg, filters, page, get_audit_snapshot(request, sg)), content_type="application/json"
+    )
+
+
 @permission_required("securegroups.audit_sec_group")
 @user_passes_test(GroupManager.can_manage_groups)
 def groups_manager_view(request, sg_id=None):
@@ -122,7 +226,7 @@ def groups_manager_view(request, sg_id=None):
     out = {}
     for u in users:
         out[u.id] = u.profile.main_character
-    for fltr in sg.filters.all():
+    for fltr in sg.get_filters():
         filters.append(fltr)
 
     context = {"sg": sg,
@@ -153,6 +257,16 @@ def groups_manager_list(request):
     ).select_related("group", "group__authgroup").annotate(num_members=Count('group__user', distinct=True),
                                                            pending_rem=Count('graceperiodrecord__user', distinct=True)).order_by('group__name')
 
+    # how long the updates take, to spot the groups getting slower
+    runs = SmartGroupRun.objects.filter(group=OuterRef("pk"), fake_run=False)
+    smart_groups_qs = smart_groups_qs.annotate(
+        last_run=Subquery(runs.order_by("-started").values("finished")[:1]),
+        last_run_duration=Subquery(runs.order_by("-started").values("duration")[:1]),
+        avg_run_duration=Subquery(
+            runs.values("group").annotate(avg=Avg("duration")).values("avg")[:1]
+        ),
+    )
+
     context = {"sgs": smart_groups_qs}
 
     return render(request, "smartgroups/audit_list.html", context=context)
@@ -196,9 +310,15 @@ def smart_group_show_check(request, group_id):
 @user_passes_test(GroupManager.can_manage_groups)
 def group_manual_refresh(request, sg_id=None):
     logger.debug("group_manual_refresh called by user %s" % request.user)
-    run_smart_group_update.apply_async(args=[sg_id], priority=4)
-    # think about doing notifications here
     sg = SmartGroup.objects.get(id=sg_id)
+    queued = []
+    sig = get_update_signature(sg, queued=queued)
+    if sig is None:
+        messages.warning(request, f"An update of '{sg.group.name}' is already queued or running")
+        return redirect("securegroups:audit_list")
+    sig.on_error(release_run_leases.si(queued))
+    sig.apply_async(priority=4)
+    # think about doing notifications here
 
     messages.info(request, f"Added Priority job for '{sg.group.name}'")
     return redirect("securegroups:audit_list")